@@ -0,0 +1,228 @@
+import argparse
+import contextlib
+import http.client
+import importlib.util
+import io
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from src.db import DB
+from src.publisher import Publisher
+from src.sim import SimBackend, SimMQTTClient, LocalBroker
+
+
+# lower is better unless listed here
+HIGHER_IS_BETTER = {"db_writes_per_sec", "db_buffered_writes_per_sec", "publish_per_sec"}
+
+
+def load_space():
+    # the entry point isn't importable by name
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intelligent-space.py")
+    spec = importlib.util.spec_from_file_location("intelligent_space", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Space
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def sim_config():
+    pins = dict(
+        lights_switch   = 11,
+        lights_relay    = 12,
+        fan_switch      = 13,
+        fan_relay       = 15,
+        door_contact    = 16,
+        motor_in_1      = 18,
+        motor_in_2      = 22,
+        motor_enable    = 29,
+        cpu_fan_enable  = 31,
+        dht_sensor      = 7,
+    )
+    feeds = dict((name, name.replace("_", "-")) for name in (
+        "lights_switch", "lights_state", "fan_switch", "fan_state", "door_lock", "door_state",
+        "tv_remote", "tv_sleep_timer", "cpu_temp", "cpu_fan_state", "room_temp", "humidity"))
+    return SimpleNamespace(pins=pins, feeds=feeds, credentials=dict(username="sim", key="sim"),
+                           publish_rate=6000, sensor_intervals=dict(cpu_temp=1, dht=2), metrics_port=0, lan_port=free_port(), lan_token="bench")
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return dict(
+        median  = statistics.median(samples),
+        p99     = samples[min(len(samples)-1, int(len(samples) * .99))],
+        mean    = statistics.mean(samples),
+    )
+
+
+def bench_space(iterations):
+    results = {}
+    backend = SimBackend()
+    config = sim_config()
+    gpio = backend.gpio
+
+    Space = load_space()
+    with contextlib.redirect_stdout(io.StringIO()):
+        space = Space(config, backend)
+        threading.Thread(target=space.loop_forever, daemon=True).start()
+
+        # wait for the simulated broker connection and the initial input states to settle
+        deadline = time.time() + 10
+        while not any(client.is_connected() for client in backend.clients) and time.time() < deadline:
+            time.sleep(.05)
+        time.sleep(.5)
+
+        # wall switch flip -> relay write
+        relay = config.pins["lights_relay"]
+        latencies = []
+        level = gpio.input(config.pins["lights_switch"])
+        for i in range(iterations):
+            level = int(not level)
+            relay_level = int(not gpio.input(relay))
+            start = gpio.bounce(config.pins["lights_switch"], level)
+            end = gpio.wait_for_output(relay, relay_level, start)
+            if end is not None:
+                latencies.append(end - start)
+            # nobody flips a switch twice inside its debounce window
+            time.sleep(.1)
+        results["switch_to_relay_ms"] = summarize([l * 1000 for l in latencies])
+
+        # adafruit io command -> relay write
+        latencies = []
+        for i in range(iterations):
+            relay_level = int(not gpio.input(relay))
+            # relay is active low, lights on drives it low
+            payload = "ON" if relay_level == 0 else "OFF"
+            start = time.perf_counter()
+            backend.broker.publish(config.feeds["lights_switch"], payload)
+            end = gpio.wait_for_output(relay, relay_level, start)
+            if end is not None:
+                latencies.append(end - start)
+        results["message_to_relay_ms"] = summarize([l * 1000 for l in latencies])
+
+        # lan api command -> relay write, a new connection per command like a phone would
+        latencies = []
+        for i in range(iterations):
+            relay_level = int(not gpio.input(relay))
+            start = time.perf_counter()
+            conn = http.client.HTTPConnection("127.0.0.1", config.lan_port)
+            conn.request("POST", "/feeds/" + config.feeds["lights_switch"], "ON" if relay_level == 0 else "OFF",
+                         {"Authorization": "Bearer " + config.lan_token})
+            conn.getresponse().read()
+            conn.close()
+            end = gpio.wait_for_output(relay, relay_level, start)
+            if end is not None:
+                latencies.append(end - start)
+        results["lan_to_relay_ms"] = summarize([l * 1000 for l in latencies])
+
+    gaps = [gap for client in backend.clients for gap in client.loop_gaps]
+    if gaps:
+        results["loop_iteration_ms"] = summarize([g * 1000 for g in gaps])
+    return results
+
+
+def bench_db(rows):
+    results = {}
+    now = datetime.now(timezone.utc)
+    with tempfile.TemporaryDirectory() as path:
+        db = DB(os.path.join(path, "direct.db"), ["feed"])
+        start = time.perf_counter()
+        for i in range(rows // 10):
+            db.insert_cur_state("feed", i, now)
+        results["db_writes_per_sec"] = rows // 10 / (time.perf_counter() - start)
+
+        db = DB(os.path.join(path, "buffered.db"), ["feed"], buffered=True)
+        start = time.perf_counter()
+        for i in range(rows):
+            db.insert_cur_state("feed", i, now)
+        db.flush()
+        results["db_buffered_writes_per_sec"] = rows / (time.perf_counter() - start)
+    return results
+
+
+def bench_publish(messages):
+    broker = LocalBroker()
+    client = SimMQTTClient("sim", "sim", broker)
+    client.connect()
+    client.loop(0)
+    publisher = Publisher(client, rate_limit=60 * 10 ** 6, burst=messages)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        publisher.publish("feed-{}".format(i), i)
+    while len(broker.received) < messages:
+        time.sleep(.001)
+    return {"publish_per_sec": messages / (time.perf_counter() - start)}
+
+
+def flatten(results):
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            for stat, stat_value in value.items():
+                flat["{}.{}".format(name, stat)] = stat_value
+        else:
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in sorted(flatten(results).items()):
+        if name not in baseline:
+            print("{:<40} {:>12.3f}".format(name, value))
+            continue
+        base = baseline[name]
+        change = (value - base) / base * 100 if base else 0
+        worse = change < -tolerance if name.split(".")[0] in HIGHER_IS_BETTER else change > tolerance
+        print("{:<40} {:>12.3f} {:>+8.1f}%{}".format(name, value, change, "  REGRESSION" if worse else ""))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="latency/throughput benchmarks against simulated hardware")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--output", help="save results as json")
+    parser.add_argument("--baseline", help="json from a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=20, help="percent change counted as a regression")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    results = {}
+    results.update(bench_db(args.iterations * 100))
+    results.update(bench_publish(args.iterations * 20))
+    cwd = os.getcwd()
+    os.chdir(workdir)                       # space writes logs/ relative to the working dir
+    try:
+        results.update(bench_space(args.iterations))
+    finally:
+        os.chdir(cwd)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(flatten(results), f, indent=2, sort_keys=True)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
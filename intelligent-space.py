@@ -1,16 +1,25 @@
+import importlib
+import multiprocessing
 import os
 import sys
 #sys.path.append('/home/pi/.local/lib/python3.5/site-packages')
-from src import config
-from Adafruit_IO import MQTTClient
-from RPi import GPIO
 import time
-from subprocess import Popen, PIPE
+import threading
 from datetime import datetime, timedelta
-import re
-import Adafruit_DHT                                             # git+https://github.com/adafruit/Adafruit_Python_DHT.git#egg=Adafruit_Python_DHT
 import logging
 from src.db import DB
+from src.publisher import Publisher
+from src.ir import IRTransmitter
+from src.connection import ConnectionManager
+from src.hardware import Hardware, HardwareClient, run_hardware
+from src.supervisor import Supervisor
+from src.timers import TimerScheduler
+from src.backends import pi_backend
+from src.devices import load_devices
+from src.filters import load_filters
+from src.rules import RuleEngine, resolve_rules
+from src.metrics import Metrics
+from src.lan import LanServer
 from dateutil import tz
 from logging.handlers import TimedRotatingFileHandler
 
@@ -21,36 +30,73 @@ from logging.handlers import TimedRotatingFileHandler
 class Space:
     __REFRESH_RATE                          = 120               # seconds
     __MAX_CPU_TEMP                          = 150               # fahrenheit (65 celcius)
+    __CPU_FAN_HYSTERESIS                    = 10                # fahrenheit below the max before the fan turns off
+    __LOOP_TIMEOUT                          = 5                 # most seconds the main loop waits on the network between timers
+    __RECONNECT_POLL                        = 1                 # seconds between connection checks while offline
+    __RULES_RELOAD_RATE                     = 10                # seconds between checks for an edited config
+    __PURGE_AGE                             = 30                # days kept in the db, older history is archived
+    __METRICS_PORT                          = 9700
+    __HARDWARE_NICE                         = -10               # added to the hardware process priority when split
     __TV_SLEEP_TIMER_DUR                    = 30                # minutes
 
+    # tv_remote payload -> lirc key
+    __TV_REMOTE_KEYS                        = {
+        "0":                                "volume_down",      # volume down
+        "1":                                "power",            # play/pause
+        "2":                                "volume_up",        # volume up
+        "4":                                "source",           # setup
+        "5":                                "arrow_up",         # arrow up
+        "6":                                "mute",             # stop/mode
+        "8":                                "arrow_left",       # arrow left
+        "9":                                "ok",               # enter/save
+        "10":                               "arrow_right",      # arrow right
+        "12":                               "0",                # 0
+        "13":                               "arrow_down",       # arrow down
+        "16":                               "1",                # 1
+        "17":                               "2",                # 2
+        "18":                               "3",                # 3
+        "20":                               "4",                # 4
+        "21":                               "5",                # 5
+        "22":                               "6",                # 6
+        "24":                               "7",                # 7
+        "25":                               "8",                # 8
+        "26":                               "9",                # 9
+    }
+    __TV_SLEEP_TIMER_KEY                    = "14"              # back
+
     __DT_FMT                                = "%a, %b %d %Y %I:%M%p %Z"
     __LOCAL_TZ                              = tz.tzlocal()
 
     __DEBUG                                 = True
 
 
-    def __init__(self, config): 
+    def __init__(self, config, backend=None, hardware=None): 
         self.config                         = config
 
+        # real hardware and adafruit io unless a simulation is passed in
+        self.__backend                      = backend if backend is not None else pi_backend(config)
 
-        self.__cur_lights_relay_state       = 0                 # start on
-        self.__cur_fan_relay_state          = 1                 # start off
-        self.__cur_cpu_fan_state            = 0                 # start off
 
-        self.__prev_lights_switch_state     = -1
-        self.__prev_fan_switch_state        = -1
-        self.__prev_door_state              = -1
+        # switches, relays, contacts, locks and sensors declared in config (or the default single room)
+        self.__devices                      = load_devices(config, self.__REFRESH_RATE)
+        self.__cur_cpu_fan_state            = 0                 # start off
 
-        self.__prev_cpu_temp                = -1
-        self.__prev_humidity                = -1
-        self.__prev_room_temp               = -1
+        # readings are smoothed and checked before anything is stored or published
+        self.__filters                      = load_filters(config)
 
         self.__cur_time                     = datetime.now(self.__LOCAL_TZ)
-        self.__prev_time                    = datetime.now(self.__LOCAL_TZ) - timedelta(seconds=self.__REFRESH_RATE)
-        self.__prev_date                    = (self.__cur_time - timedelta(days=1)).date()
+        self.__purge_time                   = None              # purge records older than this, a chunk per loop
 
         self.__is_tv_sleep_timer            = 0                 # 0 (off), 1 (30 minutes) or 2 (60 minutes)
-        self.__tv_sleep_time                = None
+        self.__tv_sleep_time                = None              # monotonic
+        self.__tv_sleep_timer               = None              # one shot turning the tv off
+        self.__tv_countdown_timer           = None              # publishes the minutes remaining
+
+        # everything periodic or delayed runs from the main loop, which sleeps until the next deadline
+        self.__timers                       = TimerScheduler()
+
+        # switch/contact events arrive on their own thread, serialize them with the main loop
+        self.__lock                         = threading.RLock()
 
 
 
@@ -72,194 +118,307 @@ class Space:
         adafruit_log.propagate = False
 
 
-        # create db to hold feed history
-        self.__db                        = DB("logs/feeds.db", self.config.feeds.values())
-
-
-        # populate prev_* variables if history exists in the db
-        lights_state_feed = self.config.feeds["lights_state"]
-        prev_lights_state = self.__db.select_prev_state(lights_state_feed)
-        if prev_lights_state is not None:
-            self.__cur_lights_relay_state = int(not prev_lights_state)
-            self.__std_out("previous {}: {}".format(lights_state_feed, "on" if prev_lights_state else "off"))
-        fan_state_feed = self.config.feeds["fan_state"]
-        prev_fan_state = self.__db.select_prev_state(fan_state_feed)
-        if prev_fan_state is not None:
-            self.__cur_fan_relay_state = int(not prev_fan_state)
-            self.__std_out("previous {}: {}".format(fan_state_feed, "on" if prev_fan_state else "off"))
-        door_contact_feed = self.config.feeds["door_state"]
-        prev_door_state = self.__db.select_prev_state(door_contact_feed)
-        if prev_door_state is not None:
-            self.__prev_door_state = prev_door_state
-            self.__std_out("previous {}: {}".format(door_contact_feed, "closed" if prev_door_state else "open"))
-
-
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setwarnings(False)
-        GPIO.setup(self.config.pins['lights_switch'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.config.pins['lights_relay'], GPIO.OUT)
-        GPIO.setup(self.config.pins['fan_switch'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.config.pins['fan_relay'], GPIO.OUT)
-        GPIO.setup(self.config.pins['door_contact'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.config.pins['motor_in_1'], GPIO.OUT)
-        GPIO.setup(self.config.pins['motor_in_2'], GPIO.OUT)
-        GPIO.setup(self.config.pins['motor_enable'], GPIO.OUT)
-        GPIO.setup(self.config.pins['cpu_fan_enable'], GPIO.OUT)
-
+        # hot path timings and counters, scraped in prometheus format
+        self.__metrics                      = Metrics()
+        self.__loop_seconds                 = self.__metrics.histogram("space_loop_seconds", "Main loop iteration time, excluding the network wait")
+        self.__messages_received            = self.__metrics.counter("space_mqtt_received_total", "Messages received from Adafruit IO")
+
+
+        # create db to hold feed history, writes are batched off the control thread
+        binary_feeds = ([relay.state_feed for relay in self.__devices.relays] + [contact.state_feed for contact in self.__devices.contacts] +
+                        [lock.feed for lock in self.__devices.locks] + [self.config.feeds["cpu_fan_state"]])
+        self.__db                        = DB("logs/feeds.db", self.config.feeds.values(), binary_feeds, buffered=True, metrics=self.__metrics,
+                                             archive_path="logs/archive")
+
+
+        # populate prev_* variables if history exists in the db, every feed comes back in one read
+        latest_states = self.__db.select_latest_states()
+        for relay in self.__devices.relays:
+            prev_state = latest_states.get(relay.state_feed)
+            if prev_state is not None:
+                relay.state = int(prev_state)
+                self.__std_out("previous {}: {}".format(relay.state_feed, "on" if prev_state else "off"))
+        for contact in self.__devices.contacts:
+            prev_state = latest_states.get(contact.state_feed)
+            if prev_state is not None:
+                contact.state = prev_state
+                self.__std_out("previous {}: {}".format(contact.state_feed, "closed" if prev_state else "open"))
+
+
+        if hardware is None:
+            # relays come up in their restored state (active low) before anything touches the network
+            hardware = Hardware(self.__backend, self.config, self.__devices, self.__lock)
+        else:
+            # a hardware process kept the relays going while this one was down, it knows better than the db
+            for relay in self.__devices.relays:
+                relay.state = hardware.relay_state(relay.name)
+        self.__hardware                     = hardware
+
+        # everything the hardware reports by kind, then device name
+        relays = dict((relay.name, relay) for relay in self.__devices.relays)
+        contacts = dict((contact.name, contact) for contact in self.__devices.contacts)
+        locks = dict((lock.name, lock) for lock in self.__devices.locks)
+        sensors = dict((sensor.name, sensor) for sensor in self.__devices.sensors)
+        self.__event_handlers = {
+            "switch":                       self.__timed('handle_switch_change', lambda name, level: self.__handle_switch_change(relays[name], level)),
+            "relay":                        self.__timed('handle_relay_change', lambda name, state: self.__handle_relay_change(relays[name], state)),
+            "contact":                      self.__timed('handle_contact_change', lambda name, level: self.__handle_contact_change(contacts[name], level)),
+            "lock":                         self.__timed('handle_lock_change', lambda name, state: self.__handle_lock_change(locks[name], state)),
+            "cpu_fan":                      self.__timed('handle_cpu_fan_change', lambda name, state: self.__handle_cpu_fan_change(state)),
+            "sensor":                       self.__timed('handle_sensor_change', lambda name, reading: self.__handle_sensor_change(sensors[name], reading)),
+        }
+
+        # one persistent lircd connection, key presses are sent in order on their own thread
+        self.__ir = IRTransmitter('tv', self.__backend.lircd_socket)
 
         # connect to adafruit io
-        self.__client = MQTTClient(self.config.credentials['username'], self.config.credentials['key'])
+        self.__client = self.__backend.mqtt_client(self.config.credentials['username'], self.config.credentials['key'])
         self.__client.on_connect = self.__on_connect
         self.__client.on_disconnect = self.__on_disconnect
-        self.__client.on_message = self.__on_message
-        self.__connect()
-
-        # client was previously not connected during call to handle_state_change(), current state may not have been published
-        self.__client.publish(lights_state_feed, self.__cur_lights_relay_state)
-        self.__client.publish(fan_state_feed, self.__cur_fan_relay_state)
-        self.__client.publish(door_contact_feed, self.__prev_door_state)
-        self.__client.publish(self.config.feeds['tv_sleep_timer'], 0)
-
-
+        self.__client.on_message = self.__timed('on_message', self.__on_message)
+
+        # feed id -> handler for everything adafruit io can command
+        self.__message_handlers = {
+            self.config.feeds['tv_remote']: self.__handle_tv_remote,
+        }
+        for relay in self.__devices.relays:
+            self.__message_handlers[relay.switch_feed] = lambda payload, relay=relay: self.__handle_relay_message(relay, payload)
+        for lock in self.__devices.locks:
+            self.__message_handlers[lock.feed] = lambda payload, lock=lock: self.__handle_lock_message(lock, payload)
+
+        # automations run the same handlers, plus the cpu fan which adafruit io can't switch
+        self.__actions = dict(self.__message_handlers)
+        self.__actions[self.config.feeds['cpu_fan_state']] = self.__handle_cpu_fan_message
+        self.__rules = RuleEngine(self.__actions, self.__metrics)
+        self.__rule_timers = {}                                 # rule name -> timer of a time of day rule
+        self.__config_mtime = self.__get_config_mtime()
+        self.__load_rules()
+
+        # publishes are coalesced per feed and rate limited on their own thread, state feeds go first
+        priority_feeds = ([relay.state_feed for relay in self.__devices.relays] + [contact.state_feed for contact in self.__devices.contacts] +
+                          [self.config.feeds["tv_sleep_timer"]])
+        # values published while offline are parked in the db and replayed after reconnecting
+        self.__publisher = Publisher(self.__client, priority_feeds, getattr(self.config, 'publish_rate', 30), outbox=self.__db)
+
+        # phones on the same network command and follow the space without the cloud round trip
+        # off unless both a port and a token are set, the door lock is one of the feeds
+        self.__lan = None
+        lan_port = getattr(self.config, 'lan_port', None)
+        lan_token = getattr(self.config, 'lan_token', None)
+        if lan_port is not None and not lan_token:
+            self.__logger.error("lan_port is set without a lan_token, LAN API not started")
+        elif lan_port is not None:
+            self.__lan_received = self.__metrics.counter("space_lan_received_total", "Commands received over the LAN API")
+            self.__lan = LanServer(self.__timed('lan_command', self.__handle_lan_command), lan_token)
+
+        # handle switches and sensor readings independently of the network, commands can come in from here on
+        self.__hardware.start(self.__handle_hardware_events)
+        # the fan rule starts out off, so does the fan
+        self.__hardware.set_cpu_fan(0)
+        if self.__lan is not None:
+            try:
+                self.__lan.serve(lan_port)
+            except OSError:
+                # port in use, everything else still runs
+                self.__logger.exception("LAN API not started")
+                self.__lan = None
+        if self.__lan is not None:
+            self.__metrics.callback("space_lan_clients", "gauge", "Websockets following state changes", self.__lan.clients)
+
+        # connects (and reconnects with backoff) in the background
+        msg = "Connecting to Adafruit IO.."
+        self.__std_out(msg)
+        self.__logger.info(msg)
+        self.__connection = ConnectionManager(self.__client)
+
+        self.__metrics.callback("space_mqtt_reconnects_total", "counter", "Reconnects to Adafruit IO", self.__connection.reconnects)
+        for stat, kind, help in (("depth", "gauge", "Feeds waiting to be published"),
+                                 ("published", "counter", "Messages published to Adafruit IO"),
+                                 ("coalesced", "counter", "Publishes replaced by a newer value before being sent"),
+                                 ("dropped", "counter", "Publishes the client failed to send")):
+            self.__metrics.callback("space_publish_{}".format(stat if kind == "gauge" else stat + "_total"), kind, help,
+                                    lambda stat=stat: self.__publisher.stats()[stat])
+        self.__metrics.callback("space_input_queue_depth", "gauge", "Input events waiting to be handled", self.__hardware.qsize)
+        self.__metrics.callback("space_ir_queue_depth", "gauge", "IR keys waiting to be sent", self.__ir.qsize)
+        metrics_port = getattr(self.config, 'metrics_port', self.__METRICS_PORT)
+        if metrics_port is not None:
+            try:
+                self.__metrics.serve(metrics_port)
+            except OSError:
+                # port in use, the relays don't need the metrics
+                self.__logger.exception("metrics endpoint not started")
+
+        # make sure the current state gets published once connected
+        for relay in self.__devices.relays:
+            self.__publish(relay.state_feed, relay.state)
+        for contact in self.__devices.contacts:
+            self.__publish(contact.state_feed, contact.state)
+        self.__publish(self.config.feeds['tv_sleep_timer'], 0)
+
+        self.__timers.call_later(0, self.__locked(self.__start_purge))
+        self.__timers.call_every(self.__REFRESH_RATE, self.__log_stats)
+        self.__timers.call_every(self.__RULES_RELOAD_RATE, self.__locked(self.__reload_rules))
+
+
+    def __timed(self, handler_name, handler):
+        return self.__metrics.histogram("space_handler_seconds", "Time spent in each handler", handler=handler_name).timed(handler)
+    def __locked(self, callback):
+        # timer callbacks that touch state, serialized with the input and sensor threads
+        def locked_callback():
+            with self.__lock:
+                self.__cur_time = datetime.now(self.__LOCAL_TZ)
+                callback()
+        return locked_callback
+    def __publish(self, feed, value):
+        # adafruit io in the background, websockets on the lan right away
+        self.__publisher.publish(feed, value)
+        if self.__lan is not None:
+            self.__lan.notify(feed, value)
     def __std_out(self, output):
         if self.__DEBUG:
             print("{}: {}".format(self.__cur_time.strftime(self.__DT_FMT), output))
 
 
-    def __change_lights_state(self, lights_state):
-        self.__cur_lights_relay_state = lights_state
-        GPIO.output(self.config.pins['lights_relay'], int(not lights_state))
-
-        lights_state_feed = self.config.feeds["lights_state"]
-        self.__std_out("{} -> {}".format(lights_state_feed, "on" if lights_state else "off"))
-        self.__db.insert_cur_state(lights_state_feed, lights_state, self.__cur_time)
-        self.__client.publish(lights_state_feed, lights_state)
-    def __change_fan_state(self, fan_state):
-        self.__cur_fan_relay_state = fan_state
-        GPIO.output(self.config.pins['fan_relay'], int(not fan_state))
-
-        fan_state_feed = self.config.feeds["fan_state"]
-        self.__std_out("{} -> {}".format(fan_state_feed, "on" if fan_state else "off"))
-        self.__db.insert_cur_state(fan_state_feed, fan_state, self.__cur_time)
-        self.__client.publish(fan_state_feed, fan_state)
-    def __change_lock_state(self, lock_state):
-        GPIO.output(self.config.pins['motor_in_1'], lock_state)
-        GPIO.output(self.config.pins['motor_in_2'], int(not lock_state))
-        GPIO.output(self.config.pins['motor_enable'], GPIO.HIGH)
-        time.sleep(.2)
-        GPIO.output(self.config.pins['motor_enable'], GPIO.LOW)
-
-        door_lock_feed = self.config.feeds["door_lock"]
-        self.__std_out("{} -> {}".format(door_lock_feed, "locked" if lock_state else "unlocked"))
-        self.__db.insert_cur_state(door_lock_feed, lock_state, self.__cur_time)
-    def __change_cpu_fan_state(self, cpu_fan_state):
+    def __handle_switch_change(self, relay, switch_level):
+        # the hardware already toggled the relay, its change follows
+        self.__std_out("{} -> {}".format(relay.switch_feed, switch_level))
+        self.__db.insert_cur_state(relay.switch_feed, switch_level, self.__cur_time)
+    def __handle_relay_change(self, relay, state):
+        relay.state = state
+
+        self.__std_out("{} -> {}".format(relay.state_feed, "on" if state else "off"))
+        self.__db.insert_cur_state(relay.state_feed, state, self.__cur_time)
+        self.__publish(relay.state_feed, state)
+        self.__rules.update(relay.state_feed, state, self.__cur_time)
+    def __handle_lock_change(self, lock, lock_state):
+        self.__std_out("{} -> {}".format(lock.feed, "locked" if lock_state else "unlocked"))
+        self.__db.insert_cur_state(lock.feed, lock_state, self.__cur_time)
+        self.__rules.update(lock.feed, lock_state, self.__cur_time)
+    def __handle_cpu_fan_change(self, cpu_fan_state):
         self.__cur_cpu_fan_state = cpu_fan_state
-        GPIO.output(self.config.pins['cpu_fan_enable'], cpu_fan_state)
 
         cpu_fan_state_feed = self.config.feeds["cpu_fan_state"]
         self.__std_out("{} -> {}".format(cpu_fan_state_feed, "on" if cpu_fan_state else "off"))
         self.__db.insert_cur_state(cpu_fan_state_feed, cpu_fan_state, self.__cur_time)
-
-    def __handle_lights_switch_state_change(self):
-        cur_lights_switch_state = GPIO.input(self.config.pins['lights_switch'])
-        if cur_lights_switch_state != self.__prev_lights_switch_state:
-            lights_switch_feed = self.config.feeds["lights_switch"]
-            self.__std_out("{} -> {}".format(lights_switch_feed, cur_lights_switch_state))
-
-            self.__prev_lights_switch_state = cur_lights_switch_state
-            self.__change_lights_state(int(not self.__cur_lights_relay_state))
-
-            self.__db.insert_cur_state(lights_switch_feed, cur_lights_switch_state, self.__cur_time)
-    def __handle_fan_switch_state_change(self):
-        cur_fan_switch_state = GPIO.input(self.config.pins['fan_switch'])
-        if cur_fan_switch_state != self.__prev_fan_switch_state:
-            fan_switch_feed = self.config.feeds["fan_switch"]
-            self.__std_out("{} -> {}".format(fan_switch_feed, cur_fan_switch_state))
-
-            self.__prev_fan_switch_state = cur_fan_switch_state
-            self.__change_fan_state(int(not self.__cur_fan_relay_state))
-
-            self.__db.insert_cur_state(fan_switch_feed, cur_fan_switch_state, self.__cur_time)
-    def __handle_door_state_change(self):
-        cur_door_state = int(not GPIO.input(self.config.pins['door_contact']))
-        if cur_door_state != self.__prev_door_state:
-            self.__prev_door_state = cur_door_state
-
-            door_state_feed = self.config.feeds["door_state"]
-            self.__std_out("{}: {}".format(door_state_feed, "closed" if cur_door_state else "open"))
-            self.__db.insert_cur_state(door_state_feed, cur_door_state, self.__cur_time)
-            self.__client.publish(door_state_feed, cur_door_state)
-
-            if cur_door_state == 1: # if just closed, lock door
-                self.__change_lock_state(1)
-    def __handle_cpu_temp_change(self):
-        # run parallel thread
-        output, error = Popen(["vcgencmd", "measure_temp"], stdout=PIPE).communicate()
-        cpu_temp = float(re.match("temp=(\d+.\d+)'C", output.decode()).group(1)) *9/5.+32
-        
-        if cpu_temp != self.__prev_cpu_temp:
-            self.__prev_cpu_temp = cpu_temp
-
-            cpu_temp_feed = self.config.feeds["cpu_temp"]
-            self.__std_out("{}: {} degrees fahrenheit".format(cpu_temp_feed, cpu_temp))
-            self.__db.insert_cur_state(cpu_temp_feed, cpu_temp, self.__cur_time)
-            self.__client.publish(cpu_temp_feed, cpu_temp)
-    
-            if cpu_temp > self.__MAX_CPU_TEMP:
-                if self.__cur_cpu_fan_state == 0:
-                    self.__change_cpu_fan_state(1)
-            elif self.__cur_cpu_fan_state == 1:
-                self.__change_cpu_fan_state(0)
-    def __handle_dht_change(self):
-        # run parallel thread
-        humidity, room_temp = Adafruit_DHT.read(Adafruit_DHT.DHT22, self.config.pins['dht_sensor'])
-        if humidity != self.__prev_humidity:
-            self.__prev_humidity = humidity
-
-            humidity_feed = self.config.feeds["humidity"]
-            self.__std_out("{}: {}".format(humidity_feed, humidity))
-            self.__db.insert_cur_state(humidity_feed, humidity, self.__cur_time)
-            if humidity:
-                self.__client.publish(humidity_feed, humidity)
-
-        if room_temp:
-            room_temp = room_temp *9/5.+32
-        if room_temp != self.__prev_room_temp:
-            self.__prev_room_temp = room_temp
-
-            room_temp_feed = self.config.feeds["room_temp"]
-            self.__std_out("{}: {}".format(room_temp_feed, room_temp))
-            self.__db.insert_cur_state(room_temp_feed, room_temp, self.__cur_time)
-            #if room_temp:
-            #    self.__client.publish(room_temp_feed, room_temp)
-    def __handle_tv_sleep_timer(self):
-        if self.__is_tv_sleep_timer > 0:
-            minutes_remaining = (self.__tv_sleep_time-self.__cur_time).total_seconds() // 60 + 1
-            if minutes_remaining <= 0:
-                # reset brightness 
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'power'])
-                self.__is_tv_sleep_timer = 0
-                minutes_remaining = 0
-
-            tv_sleep_timer_feed = self.config.feeds["tv_sleep_timer"]
-            self.__std_out("{}: {} minutes remaining".format(tv_sleep_timer_feed, minutes_remaining))
-            self.__db.insert_cur_state(tv_sleep_timer_feed, minutes_remaining, self.__cur_time)
-            self.__client.publish(tv_sleep_timer_feed, minutes_remaining)
-
-    def __handle_state_change(self):
-        self.__cur_time = datetime.now(self.__LOCAL_TZ)
-
-        self.__handle_lights_switch_state_change()
-        self.__handle_fan_switch_state_change() 
-        self.__handle_door_state_change()
-
-        if (self.__cur_time-self.__prev_time).total_seconds() > self.__REFRESH_RATE:
-            self.__prev_time = self.__cur_time#.replace(second=0)
-
-            self.__handle_cpu_temp_change()
-            self.__handle_dht_change()
-
-            self.__handle_tv_sleep_timer()
+        self.__rules.update(cpu_fan_state_feed, cpu_fan_state, self.__cur_time)
+    def __handle_contact_change(self, contact, contact_level):
+        cur_state = int(not contact_level)
+        if cur_state != contact.state:
+            contact.state = cur_state
+
+            self.__std_out("{}: {}".format(contact.state_feed, "closed" if cur_state else "open"))
+            self.__db.insert_cur_state(contact.state_feed, cur_state, self.__cur_time)
+            self.__publish(contact.state_feed, cur_state)
+            self.__rules.update(contact.state_feed, cur_state, self.__cur_time)
+    def __handle_sensor_change(self, sensor, reading):
+        now = time.monotonic()
+        values = reading if reading is not None else [None] * len(sensor.feeds)
+        for feed, value in zip(sensor.feeds, values):
+            # failed reads and glitches are dropped, small or frequent changes aren't reported
+            value, report = self.__filters[feed].update(value, now)
+            if value is None:
+                continue
+
+            if report:
+                self.__std_out("{}: {}".format(feed, value))
+                self.__db.insert_cur_state(feed, value, self.__cur_time)
+                if feed in sensor.publish:
+                    self.__publish(feed, value)
+
+            # rules (the cpu fan) follow every smoothed reading, reported or not
+            self.__rules.update(feed, value, self.__cur_time)
+    def __publish_tv_sleep_timer(self, minutes_remaining):
+        tv_sleep_timer_feed = self.config.feeds["tv_sleep_timer"]
+        self.__std_out("{}: {} minutes remaining".format(tv_sleep_timer_feed, minutes_remaining))
+        self.__db.insert_cur_state(tv_sleep_timer_feed, minutes_remaining, self.__cur_time)
+        self.__publish(tv_sleep_timer_feed, minutes_remaining)
+    def __tv_sleep_minutes_remaining(self):
+        return (self.__tv_sleep_time - time.monotonic()) // 60 + 1
+    def __stop_tv_sleep_timer(self):
+        self.__is_tv_sleep_timer = 0
+        self.__timers.cancel(self.__tv_sleep_timer)
+        self.__timers.cancel(self.__tv_countdown_timer)
+    def __handle_tv_sleep_timer_countdown(self):
+        self.__publish_tv_sleep_timer(self.__tv_sleep_minutes_remaining())
+    def __handle_tv_sleep_timer_expired(self):
+        # reset brightness
+        self.__ir.send('power')
+        self.__stop_tv_sleep_timer()
+        self.__publish_tv_sleep_timer(0)
+
+    def __start_purge(self):
+        # archive and delete records older than a month once a day, starting now and then at every local midnight
+        self.__purge_time = self.__cur_time - timedelta(days=self.__PURGE_AGE)
+        self.__timers.call_later(0, self.__purge_chunk)
+
+        midnight = datetime.combine(self.__cur_time.date() + timedelta(days=1), datetime.min.time()).replace(tzinfo=self.__LOCAL_TZ)
+        self.__timers.call_later((midnight - self.__cur_time).total_seconds(), self.__locked(self.__start_purge))
+    def __purge_chunk(self):
+        # one chunk per run_due, the network is serviced before the next one. the db has its own lock
+        if self.__db.delete_old_state_records(self.__purge_time) > 0:
+            self.__timers.call_later(0, self.__purge_chunk)
+    def __log_stats(self):
+        self.__logger.debug("publisher: {}, reconnects: {}".format(self.__publisher.stats(), self.__connection.reconnects()))
+
+    def __builtin_rules(self):
+        # the reactions the space always had, from the device registry and the cpu fan band
+        rules = []
+        locks = dict((lock.name, lock) for lock in self.__devices.locks)
+        for contact in self.__devices.contacts:
+            if contact.lock is not None: # if just closed, lock door
+                rules.append(dict(name="{}_closed_lock".format(contact.name), feed=contact.state_feed, equals=1,
+                                  then=dict(feed=locks[contact.lock].feed, payload="LOCK")))
+        cpu_fan = getattr(self.config, 'cpu_fan', {})
+        cpu_fan_state_feed = self.config.feeds["cpu_fan_state"]
+        rules.append(dict(name="cpu_fan", feed=self.config.feeds["cpu_temp"], above=cpu_fan.get('on', self.__MAX_CPU_TEMP),
+                          off_below=cpu_fan.get('off', self.__MAX_CPU_TEMP - self.__CPU_FAN_HYSTERESIS),
+                          then=dict(feed=cpu_fan_state_feed, payload="ON"), otherwise=dict(feed=cpu_fan_state_feed, payload="OFF")))
+        return rules
+    def __load_rules(self):
+        timed_rules = self.__rules.load(self.__builtin_rules() + resolve_rules(getattr(self.config, 'rules', []), self.config.feeds))
+        for timer in self.__rule_timers.values():
+            self.__timers.cancel(timer)
+        self.__rule_timers = {}
+        for rule in timed_rules:
+            self.__schedule_rule(rule)
+    def __schedule_rule(self, rule):
+        hour, minute = rule.at
+        rule_time = self.__cur_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if rule_time <= self.__cur_time:
+            rule_time += timedelta(days=1)
+        self.__rule_timers[rule.name] = self.__timers.call_later((rule_time - self.__cur_time).total_seconds(),
+                                                                 self.__locked(lambda: self.__run_timed_rule(rule)))
+    def __run_timed_rule(self, rule):
+        # scheduled for tomorrow first, whatever the action does the rule keeps firing
+        self.__schedule_rule(rule)
+        self.__rules.fire(rule, self.__cur_time)
+    def __get_config_mtime(self):
+        path = getattr(self.config, '__file__', None)
+        return os.path.getmtime(path) if path is not None else None
+    def __reload_rules(self):
+        # rules are picked up from an edited config without a restart, everything else still needs one
+        config_mtime = self.__get_config_mtime()
+        if config_mtime == self.__config_mtime:
+            return
+        self.__config_mtime = config_mtime
+        try:
+            importlib.reload(self.config)
+            self.__load_rules()
+        except Exception:
+            self.__logger.exception("rules not reloaded")
+            return
+        msg = "Rules reloaded"
+        self.__std_out(msg)
+        self.__logger.info(msg)
+    def __handle_hardware_events(self, events):
+        # from the hardware's threads or off the events ring, one lock and one clock read per batch
+        with self.__lock:
+            self.__cur_time = datetime.now(self.__LOCAL_TZ)
+            for kind, name, value in events:
+                try:
+                    self.__event_handlers[kind](name, value)
+                except Exception:
+                    self.__logger.exception("")
 
 
     def __on_connect(self, client):
@@ -267,169 +426,148 @@ class Space:
         self.__std_out(msg)
         self.__logger.info(msg)
 
-        self.__client.subscribe(self.config.feeds['lights_switch'])
-        self.__client.subscribe(self.config.feeds['fan_switch'])
-        self.__client.subscribe(self.config.feeds['door_lock'])
-        self.__client.subscribe(self.config.feeds['tv_remote'])
+        for feed_id in self.__message_handlers:
+            self.__client.subscribe(feed_id)
     def __on_disconnect(self, client):
         msg = 'Disconnected from Adafruit IO!'
         self.__std_out(msg)
         self.__logger.info(msg)
 
-        self.__connect()
+        self.__connection.reconnect()
     def __on_message(self, client, feed_id, payload):
-        if feed_id == self.config.feeds['lights_switch']:
-            if payload == "ON":
-                if self.__cur_lights_relay_state != 1:
-                    self.__change_lights_state(1)
-            else: 
-                if self.__cur_lights_relay_state != 0:
-                    self.__change_lights_state(0)
-
-        elif feed_id == self.config.feeds['fan_switch']:
-            if payload == "ON":
-                if self.__cur_fan_relay_state != 1:
-                    self.__change_fan_state(1)
-            else:
-                if self.__cur_fan_relay_state != 0:
-                    self.__change_fan_state(0)
-
-        elif feed_id == self.config.feeds['door_lock']:
-            if payload == "UNLOCK":
-                self.__change_lock_state(0)
+        self.__messages_received.inc()
+        with self.__lock:
+            self.__cur_time = datetime.now(self.__LOCAL_TZ)
+            self.__handle_message(feed_id, payload)
+    def __handle_lan_command(self, feed_id, payload):
+        # same as a message from adafruit io, False for a feed nothing listens to
+        if feed_id not in self.__message_handlers:
+            return False
+        self.__lan_received.inc()
+        with self.__lock:
+            self.__cur_time = datetime.now(self.__LOCAL_TZ)
+            self.__std_out("{} <- {} (lan)".format(feed_id, payload))
+            self.__handle_message(feed_id, payload)
+        return True
+    def __handle_message(self, feed_id, payload):
+        handler = self.__message_handlers.get(feed_id)
+        if handler is not None:
+            handler(payload)
+    def __handle_relay_message(self, relay, payload):
+        # the hardware ignores commands that don't change anything
+        self.__hardware.set_relay(relay.name, int(payload == "ON"))
+    def __handle_lock_message(self, lock, payload):
+        self.__hardware.pulse_lock(lock.name, int(payload != "UNLOCK"))
+    def __handle_cpu_fan_message(self, payload):
+        self.__hardware.set_cpu_fan(int(payload == "ON"))
+    def __handle_tv_remote(self, payload):
+        feed_id = self.config.feeds['tv_remote']
+        self.__std_out("{} <- {}".format(feed_id, payload))
+        self.__db.insert_cur_state(feed_id, payload, self.__cur_time)
+
+        if payload == self.__TV_SLEEP_TIMER_KEY: # back
+            sleep_timer_dur = self.__TV_SLEEP_TIMER_DUR * 60
+            if self.__is_tv_sleep_timer == 0:
+                self.__is_tv_sleep_timer = 1
+                # dim brightness
+                self.__tv_sleep_time = time.monotonic() + sleep_timer_dur
+                self.__tv_sleep_timer = self.__timers.call_later(sleep_timer_dur, self.__locked(self.__handle_tv_sleep_timer_expired))
+                self.__tv_countdown_timer = self.__timers.call_every(self.__REFRESH_RATE, self.__locked(self.__handle_tv_sleep_timer_countdown))
+                minutes_remaining = self.__TV_SLEEP_TIMER_DUR
+            elif self.__is_tv_sleep_timer == 1:
+                self.__is_tv_sleep_timer = 2
+                self.__tv_sleep_time += sleep_timer_dur
+                self.__timers.cancel(self.__tv_sleep_timer)
+                self.__tv_sleep_timer = self.__timers.call_later(self.__tv_sleep_time - time.monotonic(),
+                                                                 self.__locked(self.__handle_tv_sleep_timer_expired))
+                minutes_remaining = self.__tv_sleep_minutes_remaining()
             else:
-                self.__change_lock_state(1)
-
-        elif feed_id == self.config.feeds['tv_remote']:
-            self.__std_out("{} <- {}".format(feed_id, payload))
-            self.__db.insert_cur_state(feed_id, payload, self.__cur_time)
-
-            if payload == "0": # volume down
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'volume_down'])
-            elif payload == "1": # play/pause 
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'power'])
-            elif payload == "2": # volume up
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'volume_up'])
-            elif payload == "4": # setup
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'source'])
-            elif payload == "5": # arrow up
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'arrow_up'])
-            elif payload == "6": # stop/mode
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'mute'])
-            elif payload == "8": # arrow left
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'arrow_left'])
-            elif payload == "9": # enter/save
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'ok'])
-            elif payload == "10": # arrow right
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'arrow_right'])
-            elif payload == "12": # 0
-                Popen(['irsend', 'SEND_ONCE', 'tv', '0'])
-            elif payload == "13": # arrow down
-                Popen(['irsend', 'SEND_ONCE', 'tv', 'arrow_down'])
-            elif payload == "14": # back
-                #Popen(['irsend', 'SEND_ONCE', 'tv', 'back'])
-                if self.__is_tv_sleep_timer == 0:
-                    self.__is_tv_sleep_timer = 1
-                    # dim brightness
-                    self.__tv_sleep_time = self.__cur_time + timedelta(minutes=self.__TV_SLEEP_TIMER_DUR)
-                    minutes_remaining = self.__TV_SLEEP_TIMER_DUR
-                elif self.__is_tv_sleep_timer == 1:
-                    self.__is_tv_sleep_timer = 2
-                    self.__tv_sleep_time += timedelta(minutes=self.__TV_SLEEP_TIMER_DUR)
-                    minutes_remaining = (self.__tv_sleep_time-self.__cur_time).total_seconds() // 60 + 1
-                else:
-                    self.__is_tv_sleep_timer = 0
-                    # reset brightness
-                    minutes_remaining = 0
-
-                tv_sleep_timer_feed = self.config.feeds['tv_sleep_timer']
-                self.__std_out("{}: {} minutes remaining".format(tv_sleep_timer_feed, minutes_remaining))
-                self.__db.insert_cur_state(tv_sleep_timer_feed, minutes_remaining, self.__cur_time)
-                self.__client.publish(tv_sleep_timer_feed, minutes_remaining)
-            elif payload == "16": # 1
-                Popen(['irsend', 'SEND_ONCE', 'tv', '1'])
-            elif payload == "17": # 2
-                Popen(['irsend', 'SEND_ONCE', 'tv', '2'])
-            elif payload == "18": # 3
-                Popen(['irsend', 'SEND_ONCE', 'tv', '3'])
-            elif payload == "20": # 4
-                Popen(['irsend', 'SEND_ONCE', 'tv', '4'])
-            elif payload == "21": # 5
-                Popen(['irsend', 'SEND_ONCE', 'tv', '5'])
-            elif payload == "22": # 6
-                Popen(['irsend', 'SEND_ONCE', 'tv', '6'])
-            elif payload == "24": # 7
-                Popen(['irsend', 'SEND_ONCE', 'tv', '7'])
-            elif payload == "25": # 8
-                Popen(['irsend', 'SEND_ONCE', 'tv', '8'])
-            elif payload == "26": # 9
-                Popen(['irsend', 'SEND_ONCE', 'tv', '9'])
-
-    def __connect(self):
-        msg = "Connecting to Adafruit IO.."
-        self.__std_out(msg)
-        self.__logger.info(msg)
-
-        while True:
-            self.__handle_state_change() # handle state changes while trying to connect
-            try:
-                self.__client.connect()
-                return
-            except:
-                pass
-
-            time.sleep(.2)
+                self.__stop_tv_sleep_timer()
+                # reset brightness
+                minutes_remaining = 0
 
+            self.__publish_tv_sleep_timer(minutes_remaining)
+        elif payload in self.__TV_REMOTE_KEYS:
+            self.__ir.send(self.__TV_REMOTE_KEYS[payload])
 
     def loop_forever(self):
         while True:
             try:
-                #self.__client.loop_background()
-
-                # for some reason, calling client.is_connected() fails for the first few seconds
-                init_time = self.__cur_time + timedelta(seconds=2)
-                while self.__cur_time < init_time:
-                    self.__handle_state_change()
-                    self.__client.loop() # blocks for 1 second
-
-
                 # run forever 
                 while True:
-                    self.__handle_state_change()
+                    loop_start = time.perf_counter()
+                    next_timer = self.__timers.run_due()
 
-                    if self.__client.is_connected():
-                        self.__client.loop()
+                    # sleep on the network until the next timer is due, the connection manager owns reconnecting
+                    network_start = time.perf_counter()
+                    if self.__connection.is_connected():
+                        self.__client.loop(self.__LOOP_TIMEOUT if next_timer is None else min(next_timer, self.__LOOP_TIMEOUT))
                     else:
-                        msg = "No longer connected to Adafruit IO!"
-                        self.__std_out(msg)
-                        self.__logger.warn(msg)
-
-                        self.__connect()
-                        break
+                        time.sleep(self.__RECONNECT_POLL if next_timer is None else min(next_timer, self.__RECONNECT_POLL))
+                    network_time = time.perf_counter() - network_start
 
-                    # delete old db records
-                    if self.__cur_time.date() != self.__prev_date:
-                        month_ago_time = self.__cur_time - timedelta(days=30)
-                        self.__db.delete_old_state_records(month_ago_time)
-                        self.__prev_date = self.__cur_time.date()
+                    self.__loop_seconds.observe(time.perf_counter() - loop_start - network_time)
 
             except: # will not be caught during reboot
                 if self.__cur_cpu_fan_state == 1:
-                    self.__change_cpu_fan_state(0)
+                    self.__hardware.set_cpu_fan(0)
+
+                # write out any buffered history before going down
+                try:
+                    self.__db.flush()
+                except Exception:
+                    self.__logger.exception("buffered history not written")
 
                 self.__logger.exception("")
                 raise
+    @classmethod
+    def split_forever(cls, config, backend_factory=pi_backend):
+        # the pins in a small high priority process, adafruit io, the db, ir and the lan in another. either one is
+        # restarted on its own if it dies, relay states live in shared memory so neither restart touches the relays
+        from src.shared import SharedRing, SharedStates     # python 3.8+
+
+        context = multiprocessing.get_context("fork")
+        devices = load_devices(config, cls.__REFRESH_RATE)
+
+        # relays start from the db on boot, from the shared states on every restart after that
+        if not os.path.exists("logs"):
+            os.makedirs("logs")
+        db = DB("logs/feeds.db", config.feeds.values())
+        latest_states = db.select_latest_states()
+        db.close()
+        states = SharedStates([relay.name for relay in devices.relays] + ["cpu_fan"])
+        for relay in devices.relays:
+            prev_state = latest_states.get(relay.state_feed)
+            states[relay.name] = relay.state if prev_state is None else int(prev_state)
+
+        commands = SharedRing(context)
+        events = SharedRing(context)
+        supervisor = Supervisor(context)
+        supervisor.add("hardware", lambda: run_hardware(backend_factory(config), config, devices, commands, events, states),
+                       cls.__HARDWARE_NICE)
+        supervisor.add("space", lambda: cls(config, backend_factory(config), HardwareClient(commands, events, states)).loop_forever())
+        try:
+            supervisor.run_forever()
+        finally:
+            supervisor.stop()
+            for shared in (commands, events, states):
+                shared.close()
 
 
 
 
 if __name__ == "__main__":
+    from src import config
+
     # set working dir to script dir
     dir_run_from = os.getcwd()
     script_dir = os.path.dirname(sys.argv[0])
     if script_dir and script_dir != dir_run_from:
         os.chdir(script_dir)
 
-    space = Space(config)
-    space.loop_forever()
+    if getattr(config, 'split_processes', False):
+        Space.split_forever(config)
+    else:
+        space = Space(config)
+        space.loop_forever()
 
@@ -0,0 +1,72 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class ActuatorScheduler:
+    def __init__(self):
+        self.__cond                         = threading.Condition()
+        self.__timers                       = []                # heap of (deadline, seq, actuator, action)
+        self.__pending                      = {}                # actuator -> seq of its one pending action
+        self.__last_run                     = {}                # actuator -> time its last action ran
+        self.__seq                          = itertools.count()
+
+        self.__logger                       = logging.getLogger(__name__)
+
+        # one timer thread shared by every actuator, actions run while holding the scheduler lock
+        self.__worker = threading.Thread(target=self.__run_forever, name="actuators", daemon=True)
+        self.__worker.start()
+
+    def pulse(self, actuator, start, stop, duration):
+        # start() now and stop() after duration seconds, a new command supersedes a pulse in progress
+        with self.__cond:
+            self.__pending.pop(actuator, None)
+            self.__run(actuator, start)
+            self.__schedule(actuator, duration, stop)
+    def run(self, actuator, action, min_dwell=0):
+        # action() now, or once min_dwell seconds have passed since the actuator last changed
+        with self.__cond:
+            self.__pending.pop(actuator, None)
+            last_run = self.__last_run.get(actuator)
+            wait = 0 if last_run is None else last_run + min_dwell - time.monotonic()
+            if wait > 0:
+                self.__schedule(actuator, wait, action)
+            else:
+                self.__run(actuator, action)
+    def cancel(self, actuator):
+        with self.__cond:
+            self.__pending.pop(actuator, None)
+
+    def __schedule(self, actuator, delay, action):
+        seq = next(self.__seq)
+        self.__pending[actuator] = seq
+        heapq.heappush(self.__timers, (time.monotonic() + delay, seq, actuator, action))
+        self.__cond.notify()
+    def __run(self, actuator, action):
+        try:
+            action()
+        except Exception:
+            self.__logger.exception("")
+        self.__last_run[actuator] = time.monotonic()
+    def __run_forever(self):
+        with self.__cond:
+            while True:
+                if not self.__timers:
+                    self.__cond.wait()
+                    continue
+
+                deadline, seq, actuator, action = self.__timers[0]
+                if self.__pending.get(actuator) != seq:
+                    # superseded or cancelled
+                    heapq.heappop(self.__timers)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.__cond.wait(remaining)
+                    continue
+
+                heapq.heappop(self.__timers)
+                del self.__pending[actuator]
+                self.__run(actuator, action)
@@ -0,0 +1,177 @@
+import itertools
+import math
+import mmap
+import operator
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+
+
+class Archive:
+    # history purged from the db, one append-only file per month (utc) of per feed blocks.
+    # a block holds delta-encoded timestamps and xor-encoded float values, each column compressed
+    __MAGIC                                 = b"ABLK"
+    __HEADER                                = struct.Struct("<4sHIqqqIII") # magic, feed length, rows, first/last timestamp, batch, column lengths
+    __SUFFIX                                = ".arc"
+    __FINISHED                              = "finished"        # last batch whose rows are gone from the db
+
+    def __init__(self, path):
+        self.__path                         = path
+        self.__indexes                      = {}                # month -> (valid length, [(feed, first, last, offset, batch), ..], file size)
+        self.__batch                        = 0                 # one per append()
+        self.__finished                     = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for month in self.__months():
+            self.__batch = max([self.__batch] + [block[4] for block in self.__index(month)[1]])
+        finished_path = os.path.join(path, self.__FINISHED)
+        if os.path.exists(finished_path):
+            with open(finished_path) as f:
+                self.__finished = int(f.read() or 0)
+
+    def last_ids(self):
+        # db row ids of the last append(), still in the db if it went down before deleting them and finish()
+        if self.__finished >= self.__batch:
+            return []
+        ids = []
+        for month in self.__months():
+            blocks = [block for block in self.__index(month)[1] if block[4] == self.__batch]
+            if blocks:
+                with open(self.__file_path(month), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for block in blocks:
+                        ids.extend(self.__decode_ids(data, block[3]))
+        return ids
+    def append(self, rows):
+        # (id, feed, value, timestamp) rows, on disk before this returns
+        self.__batch += 1
+        months = {}
+        for row in rows:
+            months.setdefault(time.strftime("%Y-%m", time.gmtime(row[3])), []).append(row)
+
+        for month, month_rows in sorted(months.items()):
+            file_path = self.__file_path(month)
+            valid_length = self.__index(month)[0]
+            with open(file_path, "ab") as f:
+                # drop a block left half written
+                if f.tell() > valid_length:
+                    f.truncate(valid_length)
+                    f.seek(valid_length)
+
+                feeds = {}
+                for row in month_rows:
+                    feeds.setdefault(row[1], []).append(row)
+                for feed, feed_rows in sorted(feeds.items()):
+                    f.write(self.__encode(feed, feed_rows))
+                f.flush()
+                os.fsync(f.fileno())
+            self.__indexes.pop(month, None)
+    def finish(self):
+        # the rows of the last append() are deleted from the db, last_ids() has nothing left to clean up
+        finished_path = os.path.join(self.__path, self.__FINISHED)
+        with open(finished_path + ".tmp", "w") as f:
+            f.write(str(self.__batch))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(finished_path + ".tmp", finished_path)
+        self.__finished = self.__batch
+    def read(self, feed, start, end):
+        # (timestamp, value) rows of feed with start <= timestamp < end (epoch seconds), in archive order
+        rows = []
+        first_month = time.strftime("%Y-%m", time.gmtime(start))
+        last_month = time.strftime("%Y-%m", time.gmtime(max(start, end - 1)))
+        for month in self.__months():
+            if month < first_month or month > last_month:
+                continue
+
+            blocks = [block for block in self.__index(month)[1] if block[0] == feed and block[1] < end and block[2] >= start]
+            if not blocks:
+                continue
+            # only the blocks of this feed are paged in and decompressed
+            with open(self.__file_path(month), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for block in blocks:
+                    rows.extend(row for row in self.__decode(data, block[3]) if start <= row[0] < end)
+        return rows
+
+    def __file_path(self, month):
+        return os.path.join(self.__path, month + self.__SUFFIX)
+    def __months(self):
+        return sorted(name[:-len(self.__SUFFIX)] for name in os.listdir(self.__path) if name.endswith(self.__SUFFIX))
+    def __index(self, month):
+        # block headers only, payloads are skipped
+        file_path = self.__file_path(month)
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        cached = self.__indexes.get(month)
+        if cached is not None and cached[2] == size:
+            return cached
+
+        blocks = []
+        offset = 0
+        if size:
+            with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while offset + self.__HEADER.size <= size:
+                    magic, feed_length, count, first, last, batch, ids_length, timestamps_length, values_length = \
+                        self.__HEADER.unpack_from(data, offset)
+                    block_end = offset + self.__HEADER.size + feed_length + ids_length + timestamps_length + values_length
+                    if magic != self.__MAGIC or block_end > size:
+                        break
+                    feed = bytes(data[offset + self.__HEADER.size:offset + self.__HEADER.size + feed_length]).decode()
+                    blocks.append((feed, first, last, offset, batch))
+                    offset = block_end
+        index = (offset, blocks, size)
+        self.__indexes[month] = index
+        return index
+
+    @staticmethod
+    def __deltas(numbers):
+        # first number as is, the rest as the difference from the previous one
+        numbers = list(numbers)
+        return array("q", (number - prev_number for prev_number, number in zip([0] + numbers, numbers)))
+    @staticmethod
+    def __column(numbers):
+        if sys.byteorder == "big":
+            numbers.byteswap()
+        return zlib.compress(numbers.tobytes(), 9)
+    @staticmethod
+    def __uncolumn(typecode, data):
+        numbers = array(typecode)
+        numbers.frombytes(zlib.decompress(data))
+        if sys.byteorder == "big":
+            numbers.byteswap()
+        return numbers
+    def __encode(self, feed, rows):
+        ids = self.__column(self.__deltas(row[0] for row in rows))
+        timestamps = self.__column(self.__deltas(row[3] for row in rows))
+        # consecutive readings share most of their bits, xor leaves mostly zeros to compress
+        values = array("Q")
+        values.frombytes(array("d", (self.__to_float(row[2]) for row in rows)).tobytes())
+        values = self.__column(array("Q", (bits ^ prev_bits for prev_bits, bits in zip(itertools.chain([0], values), values))))
+
+        feed = feed.encode()
+        header = self.__HEADER.pack(self.__MAGIC, len(feed), len(rows), min(row[3] for row in rows), max(row[3] for row in rows),
+                                    self.__batch, len(ids), len(timestamps), len(values))
+        return header + feed + ids + timestamps + values
+    def __decode_ids(self, data, offset):
+        magic, feed_length, count, first, last, batch, ids_length, timestamps_length, values_length = self.__HEADER.unpack_from(data, offset)
+        offset += self.__HEADER.size + feed_length
+        return itertools.accumulate(self.__uncolumn("q", data[offset:offset + ids_length]))
+    def __decode(self, data, offset):
+        magic, feed_length, count, first, last, batch, ids_length, timestamps_length, values_length = self.__HEADER.unpack_from(data, offset)
+        offset += self.__HEADER.size + feed_length + ids_length
+        timestamps = itertools.accumulate(self.__uncolumn("q", data[offset:offset + timestamps_length]))
+        offset += timestamps_length
+        values = array("Q", itertools.accumulate(self.__uncolumn("Q", data[offset:offset + values_length]), operator.xor))
+        floats = array("d")
+        floats.frombytes(values.tobytes())
+        return [(timestamp, None if math.isnan(value) else value) for timestamp, value in zip(timestamps, floats)]
+
+    @staticmethod
+    def __to_float(value):
+        # STATES values are floats, None (failed reads) is stored as nan
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return float("nan")
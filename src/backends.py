@@ -0,0 +1,22 @@
+class Backend:
+    # everything Space touches outside the process, swapped for simulations off the pi (see src/sim.py)
+    def __init__(self, gpio, mqtt_client, read_dht, read_cpu_temp, lircd_socket):
+        self.gpio                           = gpio              # RPi.GPIO compatible module
+        self.mqtt_client                    = mqtt_client       # (username, key) -> Adafruit_IO.MQTTClient compatible client
+        self.read_dht                       = read_dht          # pin -> (humidity, celsius) or None
+        self.read_cpu_temp                  = read_cpu_temp     # () -> celsius
+        self.lircd_socket                   = lircd_socket      # path of the lircd unix socket
+
+
+def mqtt_client(username, key):
+    # paho and Adafruit_IO take a while to import on a pi zero, not needed until after the relays are restored
+    from Adafruit_IO import MQTTClient
+    return MQTTClient(username, key)
+
+
+def pi_backend(config):
+    # hardware libraries only import on a pi, keep them out of module scope
+    from RPi import GPIO
+    from src.sensors import CpuTemp, read_dht
+
+    return Backend(GPIO, mqtt_client, read_dht, CpuTemp().read, getattr(config, 'lircd_socket', '/var/run/lirc/lircd'))
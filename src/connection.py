@@ -0,0 +1,55 @@
+import logging
+import random
+import threading
+import time
+
+
+class ConnectionManager:
+    __MIN_BACKOFF                           = .5                # seconds
+    __MAX_BACKOFF                           = 60                # seconds
+
+    def __init__(self, client):
+        self.__client                       = client
+        self.__cond                         = threading.Condition()
+        self.__connected                    = False             # socket is up, the client can be looped
+        self.__connects                     = 0
+
+        self.__logger                       = logging.getLogger(__name__)
+
+        # the only place connect() is ever called from
+        self.__worker = threading.Thread(target=self.__connect_forever, name="connection", daemon=True)
+        self.__worker.start()
+
+    def is_connected(self):
+        return self.__connected
+    def reconnect(self):
+        # called when the connection dropped, the worker takes it from here
+        with self.__cond:
+            self.__connected = False
+            self.__cond.notify()
+    def reconnects(self):
+        return max(self.__connects - 1, 0)
+
+    def __connect_forever(self):
+        backoff = self.__MIN_BACKOFF
+        while True:
+            try:
+                self.__client.connect()
+            except Exception as e:
+                self.__logger.debug("connect failed, retrying within {:.1f}s: {}".format(backoff, e))
+            else:
+                connected_time = time.monotonic()
+                with self.__cond:
+                    self.__connected = True
+                    self.__connects += 1
+                    while self.__connected:
+                        self.__cond.wait()
+
+                # a connection that held up is retried right away, a flapping one backs off
+                if time.monotonic() - connected_time >= self.__MAX_BACKOFF:
+                    backoff = self.__MIN_BACKOFF
+                    continue
+
+            # full jitter keeps every client from hammering the broker in lock step when the link returns
+            time.sleep(random.uniform(0, backoff))
+            backoff = min(backoff * 2, self.__MAX_BACKOFF)
@@ -1,20 +1,76 @@
+import logging
 import os
 import sqlite3 as sql
+import threading
+import time
+from src.archive import Archive
 
 
 class DB:
+    __SCHEMA_VERSION    = 4
+    __BATCH_SIZE        = 50                # rows
+    __FLUSH_INTERVAL    = 10                # seconds
+    __RETRY_DELAY       = 10                # seconds before a failed batch is written again
+    __PURGE_CHUNK_SIZE  = 500               # rows deleted per commit
+    __ROLLUP_PERIODS    = (86400, 3600, 60) # seconds, coarsest first
+    __ON_TIME_PERIODS   = (86400, 3600)     # a minute bucket per minute something stays on would be too many rows
 
-    def __init__(self, path, feeds):
+    def __init__(self, path, feeds, binary_feeds=(), buffered=False, batch_size=__BATCH_SIZE, flush_interval=__FLUSH_INTERVAL, metrics=None,
+                 archive_path=None):
         db_exists = False
         if os.path.exists(path):
             db_exists = True
 
-        self.__conn     = sql.connect(path)
+        # accessed from the main loop, the input event thread and the writer thread
+        self.__conn     = sql.connect(path, check_same_thread=False)
         self.__cur      = self.__conn.cursor()
+        self.__lock     = threading.RLock()     # guards the connection
+
+        # wal lets commits append instead of rewriting pages, normal sync skips the fsync per commit
+        self.__cur.execute("PRAGMA journal_mode=WAL")
+        self.__cur.execute("PRAGMA synchronous=NORMAL")
 
         if not db_exists:
             self.__initialize_tables(feeds)
-        self.__select_feeds()
+        self.__migrate()
+        self.__select_feeds(feeds)
+
+        # on-time is tracked for on/off feeds from the previous value and when it was set, time spent down
+        # isn't on-time so the last value counts from now
+        self.__binary_feed_ids  = set(self.__feed_ids[feed] for feed in binary_feeds)
+        self.__cur.execute("""SELECT FEED_ID,
+                                     [VALUE]
+                              FROM LATEST_STATE""")
+        now = int(time.time())
+        self.__last_states      = dict((feed_id, (value, now)) for feed_id, value in self.__cur.fetchall()
+                                       if feed_id in self.__binary_feed_ids)     # feed id -> (value, timestamp)
+
+        # write behind, rows are queued and committed in batches by a background thread
+        self.__pending          = []
+        self.__pending_cond     = threading.Condition()
+        self.__buffered         = buffered
+        self.__batch_size       = batch_size
+        self.__flush_interval   = flush_interval
+
+        self.__logger           = logging.getLogger(__name__)
+        # time what callers wait on and what the sd card costs, nothing is wrapped without metrics
+        if metrics is not None:
+            self.insert_cur_state = metrics.histogram("space_db_insert_seconds", "Time spent in DB.insert_cur_state").timed(self.insert_cur_state)
+            self.__insert_rows = metrics.histogram("space_db_commit_seconds", "Time spent writing and committing a batch of rows").timed(self.__insert_rows)
+
+        # purged rows are moved here instead of being thrown away
+        self.__archive          = Archive(archive_path) if archive_path is not None else None
+        if self.__archive is not None:
+            # finish a purge that went down between archiving rows and deleting them
+            self.__cur.executemany("""DELETE FROM STATES
+                                      WHERE ID = ?""",
+                                   [(row_id, ) for row_id in self.__archive.last_ids()])
+            self.__conn.commit()
+            self.__archive.finish()
+
+        if self.__buffered:
+            self.__writer = threading.Thread(target=self.__write_forever, name="db-writer", daemon=True)
+            self.__writer.start()
 
     def __initialize_tables(self, feeds):
         self.__cur.execute("""CREATE TABLE FEEDS(
@@ -30,31 +86,323 @@ class DB:
                                   [VALUE]       FLOAT,
                                   [TIMESTAMP]   TIMESTAMP)""")
         self.__conn.commit()
-    def __select_feeds(self):
+    def __migrate(self):
+        self.__cur.execute("PRAGMA user_version")
+        version = self.__cur.fetchone()[0]
+
+        if version < 1:
+            # timestamps used to be stored as datetime strings, store them as epoch seconds
+            self.__cur.execute("""UPDATE STATES
+                                  SET [TIMESTAMP] = CAST(strftime('%s', [TIMESTAMP]) AS INTEGER)
+                                  WHERE typeof([TIMESTAMP]) = 'text'""")
+            self.__cur.execute("""CREATE INDEX IF NOT EXISTS STATES_FEED_ID_ID
+                                  ON STATES(FEED_ID, ID)""")
+            self.__cur.execute("""CREATE INDEX IF NOT EXISTS STATES_TIMESTAMP
+                                  ON STATES([TIMESTAMP])""")
+
+        if version < 2:
+            # per feed min/max/mean/count (and on-time for on/off feeds) over fixed periods
+            self.__cur.execute("""CREATE TABLE ROLLUPS(
+                                      FEED_ID       INTEGER,
+                                      PERIOD        INTEGER,
+                                      BUCKET        INTEGER,
+                                      [MIN]         FLOAT,
+                                      [MAX]         FLOAT,
+                                      [SUM]         FLOAT,
+                                      [COUNT]       INTEGER,
+                                      ON_TIME       INTEGER,
+                                      PRIMARY KEY(FEED_ID, PERIOD, BUCKET))""")
+            # backfill from existing history (on-time starts accumulating from here on)
+            for period in self.__ROLLUP_PERIODS:
+                self.__cur.execute("""INSERT INTO ROLLUPS(FEED_ID, PERIOD, BUCKET, [MIN], [MAX], [SUM], [COUNT], ON_TIME)
+                                      SELECT FEED_ID, ?, [TIMESTAMP] / ? * ?, min([VALUE]), max([VALUE]), total([VALUE]), count([VALUE]), 0
+                                      FROM STATES
+                                      WHERE typeof([VALUE]) IN ('integer', 'real')
+                                      GROUP BY FEED_ID, [TIMESTAMP] / ?""",
+                                   (period, period, period, period))
+
+        if version < 3:
+            # latest unpublished value per feed while adafruit io is unreachable
+            self.__cur.execute("""CREATE TABLE OUTBOX(
+                                      FEED_ID       INTEGER         PRIMARY KEY,
+                                      [VALUE])""")
+
+        if version < 4:
+            # last row per feed, kept up to date on every insert so startup reads it in one go
+            self.__cur.execute("""CREATE TABLE LATEST_STATE(
+                                      FEED_ID       INTEGER         PRIMARY KEY,
+                                      [VALUE]       FLOAT,
+                                      [TIMESTAMP]   TIMESTAMP)""")
+            self.__cur.execute("""INSERT INTO LATEST_STATE(FEED_ID, [VALUE], [TIMESTAMP])
+                                  SELECT FEED_ID, [VALUE], [TIMESTAMP]
+                                  FROM STATES
+                                  WHERE ID IN (SELECT max(ID)
+                                               FROM STATES
+                                               GROUP BY FEED_ID)""")
+
+        self.__cur.execute("PRAGMA user_version = {}".format(self.__SCHEMA_VERSION))
+        self.__conn.commit()
+    def __select_feeds(self, feeds):
         # select order matters in creating dictionary from key-value pairs
         self.__cur.execute("""SELECT FEED,
                                      ID
                               FROM FEEDS""")
         self.__feed_ids = dict(self.__cur.fetchall())
 
-    def insert_cur_state(self, feed, value, timestamp):
-        self.__cur.execute("""INSERT INTO STATES(FEED_ID, [VALUE], [TIMESTAMP])
-                              VALUES(?, ?, ?)""", 
-                           (self.__feed_ids[feed], value, timestamp))
+        # feeds of devices added since the db was created
+        new_feeds = [feed for feed in feeds if feed not in self.__feed_ids]
+        if new_feeds:
+            self.__cur.executemany("""INSERT INTO FEEDS(FEED)
+                                      VALUES(?)""",
+                                   [(feed, ) for feed in new_feeds])
+            self.__conn.commit()
+            return self.__select_feeds(feeds)
+        self.__feeds = dict((feed_id, feed) for feed, feed_id in self.__feed_ids.items())
+
+    def __write_forever(self):
+        while True:
+            with self.__pending_cond:
+                while not self.__pending:
+                    self.__pending_cond.wait()
+                # give the batch time to fill up, woken early once it is full
+                if len(self.__pending) < self.__batch_size:
+                    self.__pending_cond.wait(self.__flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # the rows are still pending, try again in a bit instead of losing them with the thread
+                self.__logger.exception("writing {} rows failed".format(len(self.__pending)))
+                time.sleep(self.__RETRY_DELAY)
+    def __insert_rows(self, rows):
+        for feed_id, value, timestamp in rows:
+            self.__update_rollups(feed_id, value, timestamp)
+        self.__cur.executemany("""INSERT INTO STATES(FEED_ID, [VALUE], [TIMESTAMP])
+                                  VALUES(?, ?, ?)""",
+                               rows)
+        # rows are in insert order, the last one per feed wins
+        self.__cur.executemany("""INSERT OR REPLACE INTO LATEST_STATE(FEED_ID, [VALUE], [TIMESTAMP])
+                                  VALUES(?, ?, ?)""",
+                               rows)
         self.__conn.commit()
+    def __update_rollups(self, feed_id, value, timestamp):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+
+        if feed_id in self.__binary_feed_ids:
+            last_state = self.__last_states.get(feed_id)
+            if last_state and last_state[0]:
+                self.__add_on_time(feed_id, last_state[1], timestamp)
+            self.__last_states[feed_id] = (value, timestamp)
+
+        for period in self.__ROLLUP_PERIODS:
+            bucket = self.__ensure_rollup(feed_id, period, timestamp)
+            self.__cur.execute("""UPDATE ROLLUPS
+                                  SET [MIN]   = min(coalesce([MIN], :value), :value),
+                                      [MAX]   = max(coalesce([MAX], :value), :value),
+                                      [SUM]   = [SUM] + :value,
+                                      [COUNT] = [COUNT] + 1
+                                  WHERE FEED_ID = :feed_id AND PERIOD = :period AND BUCKET = :bucket""",
+                               dict(value=value, feed_id=feed_id, period=period, bucket=bucket))
+    def __add_on_time(self, feed_id, start, end):
+        # split the on interval over every hour and day it overlaps
+        for period in self.__ON_TIME_PERIODS:
+            spans = []
+            bucket = start // period * period
+            while bucket < end:
+                spans.append((min(bucket + period, end) - max(bucket, start), feed_id, period, bucket))
+                bucket += period
+            self.__cur.executemany("""INSERT OR IGNORE INTO ROLLUPS(FEED_ID, PERIOD, BUCKET, [MIN], [MAX], [SUM], [COUNT], ON_TIME)
+                                      VALUES(?, ?, ?, NULL, NULL, 0, 0, 0)""",
+                                   [span[1:] for span in spans])
+            self.__cur.executemany("""UPDATE ROLLUPS
+                                      SET ON_TIME = ON_TIME + ?
+                                      WHERE FEED_ID = ? AND PERIOD = ? AND BUCKET = ?""",
+                                   spans)
+    def __ensure_rollup(self, feed_id, period, timestamp):
+        bucket = timestamp // period * period
+        self.__cur.execute("""INSERT OR IGNORE INTO ROLLUPS(FEED_ID, PERIOD, BUCKET, [MIN], [MAX], [SUM], [COUNT], ON_TIME)
+                              VALUES(?, ?, ?, NULL, NULL, 0, 0, 0)""",
+                           (feed_id, period, bucket))
+        return bucket
+
+    @staticmethod
+    def __to_epoch(timestamp):
+        return int(timestamp.timestamp())
+
+    def insert_cur_state(self, feed, value, timestamp):
+        row = (self.__feed_ids[feed], value, self.__to_epoch(timestamp))
+        if not self.__buffered:
+            with self.__lock:
+                self.__insert_rows([row])
+            return
+
+        with self.__pending_cond:
+            self.__pending.append(row)
+            if len(self.__pending) == 1 or len(self.__pending) >= self.__batch_size:
+                self.__pending_cond.notify()
+    def flush(self):
+        # taking rows and writing them under the same lock keeps them in insert order
+        with self.__lock:
+            with self.__pending_cond:
+                rows, self.__pending = self.__pending, []
+            if not rows:
+                return
+            last_states = dict(self.__last_states)
+            try:
+                self.__insert_rows(rows)
+            except Exception:
+                # nothing of the batch is kept, on-time goes back to where it was before it
+                self.__conn.rollback()
+                self.__last_states = last_states
+                with self.__pending_cond:
+                    self.__pending[:0] = rows
+                raise
+    def close(self):
+        # unbuffered dbs only, the writer thread keeps using the connection
+        with self.__lock:
+            self.__conn.close()
     def select_prev_state(self, feed):
-        self.__cur.execute("""SELECT [VALUE]
-                              FROM STATES
-                              WHERE FEED_ID = ?
-                              ORDER BY ID DESC
-                              LIMIT 1""", 
-                           (self.__feed_ids[feed], ))
-        row = self.__cur.fetchone()
-        if row:
-            return row[0]
-        return None
-
-    def delete_old_state_records(self, old_time):
-        self.__cur.execute("""DELETE FROM STATES 
-                              WHERE TIMESTAMP < ?""", 
-                          (old_time,))
+        return self.select_latest_states().get(feed)
+    def select_latest_states(self):
+        # feed -> last value for every feed with history, one read and no flush
+        with self.__lock:
+            self.__cur.execute("""SELECT FEED_ID,
+                                         [VALUE]
+                                  FROM LATEST_STATE""")
+            latest_states = dict(self.__cur.fetchall())
+            with self.__pending_cond:
+                for feed_id, value, timestamp in self.__pending:
+                    latest_states[feed_id] = value
+        return dict((self.__feeds[feed_id], value) for feed_id, value in latest_states.items())
+
+    def query_range(self, feed, start, end, resolution=None):
+        # without a resolution returns raw (timestamp, value) rows, otherwise one
+        # (bucket start, min, max, mean, count, on-time) row per resolution seconds starting at start.
+        # timestamps are epoch seconds, on-time is None when answered from raw rows or minute rollups.
+        # raw rows span the archive and the live table
+        feed_id = self.__feed_ids[feed]
+        start = self.__to_epoch(start)
+        end = self.__to_epoch(end)
+
+        with self.__lock:
+            self.flush()
+            if resolution is None:
+                archived_rows = self.__archive.read(feed, start, end) if self.__archive is not None else []
+                self.__cur.execute("""SELECT [TIMESTAMP],
+                                             [VALUE]
+                                      FROM STATES
+                                      WHERE FEED_ID = ? AND [TIMESTAMP] >= ? AND [TIMESTAMP] < ?
+                                      ORDER BY ID""",
+                                   (feed_id, start, end))
+                return archived_rows + self.__cur.fetchall()
+
+            # coarsest rollup whose buckets fit exactly inside the requested ones
+            for period in self.__ROLLUP_PERIODS:
+                if resolution % period == 0 and start % period == 0 and end % period == 0:
+                    self.__cur.execute("""SELECT (BUCKET - :start) / :resolution * :resolution + :start,
+                                                 min([MIN]),
+                                                 max([MAX]),
+                                                 total([SUM]) / sum([COUNT]),
+                                                 sum([COUNT]),
+                                                 {}
+                                          FROM ROLLUPS
+                                          WHERE FEED_ID = :feed_id AND PERIOD = :period AND BUCKET >= :start AND BUCKET < :end
+                                          GROUP BY (BUCKET - :start) / :resolution
+                                          ORDER BY BUCKET""".format("sum(ON_TIME)" if period in self.__ON_TIME_PERIODS else "NULL"),
+                                       dict(start=start, end=end, resolution=resolution, feed_id=feed_id, period=period))
+                    return self.__cur.fetchall()
+
+            # no rollup fits, only now is it worth decompressing archived rows
+            archived_rows = self.__archive.read(feed, start, end) if self.__archive is not None else []
+            if archived_rows:
+                self.__cur.execute("""SELECT [TIMESTAMP],
+                                             [VALUE]
+                                      FROM STATES
+                                      WHERE FEED_ID = ? AND [TIMESTAMP] >= ? AND [TIMESTAMP] < ?""",
+                                   (feed_id, start, end))
+                return self.__aggregate(archived_rows + self.__cur.fetchall(), start, resolution)
+
+            self.__cur.execute("""SELECT ([TIMESTAMP] - :start) / :resolution * :resolution + :start,
+                                         min([VALUE]),
+                                         max([VALUE]),
+                                         avg([VALUE]),
+                                         count([VALUE]),
+                                         NULL
+                                  FROM STATES
+                                  WHERE FEED_ID = :feed_id AND [TIMESTAMP] >= :start AND [TIMESTAMP] < :end
+                                        AND typeof([VALUE]) IN ('integer', 'real')
+                                  GROUP BY ([TIMESTAMP] - :start) / :resolution
+                                  ORDER BY [TIMESTAMP]""",
+                               dict(start=start, end=end, resolution=resolution, feed_id=feed_id))
+            return self.__cur.fetchall()
+
+    @staticmethod
+    def __aggregate(rows, start, resolution):
+        # same rows the raw STATES query returns, for buckets that reach into the archive
+        buckets = {}
+        for timestamp, value in rows:
+            if isinstance(value, (int, float)):
+                bucket = buckets.setdefault((timestamp - start) // resolution * resolution + start, [value, value, 0., 0])
+                bucket[0] = min(bucket[0], value)
+                bucket[1] = max(bucket[1], value)
+                bucket[2] += value
+                bucket[3] += 1
+        return [(bucket, low, high, total / count, count, None) for bucket, (low, high, total, count) in sorted(buckets.items())]
+
+    def outbox_put(self, feed, value):
+        # durable right away, replaces anything already waiting for the feed
+        with self.__lock:
+            self.__cur.execute("""INSERT OR REPLACE INTO OUTBOX(FEED_ID, [VALUE])
+                                  VALUES(?, ?)""",
+                               (self.__feed_ids[feed], value))
+            self.__conn.commit()
+    def outbox_take(self):
+        # removes and returns every (feed, value) waiting to be published
+        with self.__lock:
+            self.__cur.execute("""SELECT FEEDS.FEED,
+                                         OUTBOX.[VALUE]
+                                  FROM OUTBOX
+                                  JOIN FEEDS ON FEEDS.ID = OUTBOX.FEED_ID""")
+            rows = self.__cur.fetchall()
+            if rows:
+                self.__cur.execute("DELETE FROM OUTBOX")
+                self.__conn.commit()
+        return rows
+
+    def delete_old_state_records(self, old_time, limit=__PURGE_CHUNK_SIZE):
+        # deletes at most limit rows per call so a large purge can be spread out, returns rows deleted.
+        # with an archive the rows are written (and synced) there first
+        with self.__lock:
+            self.flush()
+            if self.__archive is None:
+                self.__cur.execute("""DELETE FROM STATES
+                                      WHERE ID IN (SELECT ID
+                                                   FROM STATES
+                                                   WHERE [TIMESTAMP] < ?
+                                                   LIMIT ?)""",
+                                   (self.__to_epoch(old_time), limit))
+                self.__conn.commit()
+                return self.__cur.rowcount
+
+            self.__cur.execute("""SELECT ID,
+                                         FEED_ID,
+                                         [VALUE],
+                                         [TIMESTAMP]
+                                  FROM STATES
+                                  WHERE [TIMESTAMP] < ?
+                                  ORDER BY ID
+                                  LIMIT ?""",
+                               (self.__to_epoch(old_time), limit))
+            rows = self.__cur.fetchall()
+            if not rows:
+                return 0
+            self.__archive.append([(row_id, self.__feeds[feed_id], value, timestamp) for row_id, feed_id, value, timestamp in rows])
+            self.__cur.executemany("""DELETE FROM STATES
+                                      WHERE ID = ?""",
+                                   [(row[0], ) for row in rows])
+            self.__conn.commit()
+            # ids aren't autoincrement, once the table empties they're handed out again and must not be deleted on the next start
+            self.__archive.finish()
+            return len(rows)
@@ -0,0 +1,100 @@
+class SwitchedRelay:
+    # wall switch toggling an (active low) relay, also switched from its adafruit io feed
+    __slots__ = ("name", "switch_pin", "relay_pin", "switch_feed", "state_feed", "debounce", "state", "switch_level")
+
+    def __init__(self, name, switch_pin, relay_pin, switch_feed, state_feed, debounce=None, default=0):
+        self.name                           = name
+        self.switch_pin                     = switch_pin
+        self.relay_pin                      = relay_pin
+        self.switch_feed                    = switch_feed       # wall switch level history, commands from adafruit io
+        self.state_feed                     = state_feed
+        self.debounce                       = debounce          # milliseconds, None for the input engine's default
+        self.state                          = default           # 1 (on) or 0 (off)
+        self.switch_level                   = -1
+
+
+class Contact:
+    # reed switch, closed pulls the pin low
+    __slots__ = ("name", "pin", "state_feed", "lock", "debounce", "state")
+
+    def __init__(self, name, pin, state_feed, lock=None, debounce=None):
+        self.name                           = name
+        self.pin                            = pin
+        self.state_feed                     = state_feed
+        self.lock                           = lock              # name of the lock to lock when closed
+        self.debounce                       = debounce
+        self.state                          = -1                # 1 (closed) or 0 (open)
+
+
+class Lock:
+    # dc motor driven through an h-bridge, pulsed one way or the other
+    __slots__ = ("name", "in_1_pin", "in_2_pin", "enable_pin", "feed")
+
+    def __init__(self, name, in_1_pin, in_2_pin, enable_pin, feed):
+        self.name                           = name
+        self.in_1_pin                       = in_1_pin
+        self.in_2_pin                       = in_2_pin
+        self.enable_pin                     = enable_pin
+        self.feed                           = feed
+
+
+class Sensor:
+    # sampled on a worker thread, a reading is one value per feed
+    __slots__ = ("name", "kind", "pin", "interval", "feeds", "publish")
+
+    def __init__(self, name, kind, pin, interval, feeds, publish=()):
+        self.name                           = name
+        self.kind                           = kind              # "cpu_temp" or "dht22"
+        self.pin                            = pin
+        self.interval                       = interval          # seconds
+        self.feeds                          = feeds
+        self.publish                        = publish           # feeds sent to adafruit io, the rest are only logged
+
+
+class Devices:
+    def __init__(self, relays, contacts, locks, sensors):
+        self.relays                         = relays
+        self.contacts                       = contacts
+        self.locks                          = locks
+        self.sensors                        = sensors
+
+
+# what the hand wired space had, used when config doesn't declare devices
+DEFAULT_DEVICES = dict(
+    relays = [
+        dict(name='lights', switch='lights_switch', relay='lights_relay', switch_feed='lights_switch', state_feed='lights_state', default=1),
+        dict(name='fan', switch='fan_switch', relay='fan_relay', switch_feed='fan_switch', state_feed='fan_state', default=0),
+    ],
+    contacts = [
+        dict(name='door', pin='door_contact', state_feed='door_state', lock='door_lock'),
+    ],
+    locks = [
+        dict(name='door_lock', in_1='motor_in_1', in_2='motor_in_2', enable='motor_enable', feed='door_lock'),
+    ],
+    sensors = [
+        dict(name='cpu_temp', kind='cpu_temp', feeds=['cpu_temp'], publish=['cpu_temp']),
+        dict(name='dht', kind='dht22', pin='dht_sensor', feeds=['humidity', 'room_temp'], publish=['humidity']),
+    ],
+)
+
+
+def load_devices(config, default_interval):
+    # pins and feeds are referenced by their names in config.pins and config.feeds
+    declared = getattr(config, 'devices', DEFAULT_DEVICES)
+    debounce = getattr(config, 'debounce', {})
+    sensor_intervals = getattr(config, 'sensor_intervals', {})
+    pins = config.pins
+    feeds = config.feeds
+
+    relays = [SwitchedRelay(device['name'], pins[device['switch']], pins[device['relay']], feeds[device['switch_feed']],
+                            feeds[device['state_feed']], debounce.get(device['switch']), device.get('default', 0))
+              for device in declared.get('relays', ())]
+    contacts = [Contact(device['name'], pins[device['pin']], feeds[device['state_feed']], device.get('lock'), debounce.get(device['pin']))
+                for device in declared.get('contacts', ())]
+    locks = [Lock(device['name'], pins[device['in_1']], pins[device['in_2']], pins[device['enable']], feeds[device['feed']])
+             for device in declared.get('locks', ())]
+    sensors = [Sensor(device['name'], device['kind'], pins[device['pin']] if 'pin' in device else None,
+                      device.get('interval', sensor_intervals.get(device['name'], default_interval)),
+                      [feeds[feed] for feed in device['feeds']], [feeds[feed] for feed in device.get('publish', ())])
+               for device in declared.get('sensors', ())]
+    return Devices(relays, contacts, locks, sensors)
@@ -0,0 +1,83 @@
+from collections import deque
+
+
+class SensorFilter:
+    # readings -> smoothed values, and which of those are worth storing and publishing
+    __slots__ = ("__valid", "__max_step", "__window", "__alpha", "__deadband", "__min_interval",
+                 "__accepted", "__smoothed", "__rejected", "__reported", "__reported_time")
+
+    def __init__(self, valid=None, max_step=None, median=1, ema=None, deadband=0, min_interval=0):
+        self.__valid                        = valid             # (low, high) a reading has to fall in
+        self.__max_step                     = max_step          # a single reading jumping further than this is dropped
+        self.__window                       = deque(maxlen=median)
+        self.__alpha                        = ema               # exponential moving average weight of a new reading
+        self.__deadband                     = deadband          # smallest change reported
+        self.__min_interval                 = min_interval      # seconds between reports
+
+        self.__accepted                     = None              # last reading that got through
+        self.__smoothed                     = None
+        self.__rejected                     = 0                 # spikes dropped in a row
+        self.__reported                     = None
+        self.__reported_time                = None
+
+    def update(self, value, now):
+        # returns (smoothed value or None if the reading was rejected, whether to report it)
+        if not isinstance(value, (int, float)):
+            return None, False
+        if self.__valid is not None and not self.__valid[0] <= value <= self.__valid[1]:
+            return None, False
+        if self.__max_step is not None and self.__accepted is not None and abs(value - self.__accepted) > self.__max_step:
+            # one reading off on its own is a glitch, a second one means the value really moved
+            self.__rejected += 1
+            if self.__rejected < 2:
+                return None, False
+        self.__rejected = 0
+        self.__accepted = value
+
+        self.__window.append(value)
+        value = sorted(self.__window)[len(self.__window) // 2]
+        if self.__alpha is not None and self.__smoothed is not None:
+            value = self.__smoothed + self.__alpha * (value - self.__smoothed)
+        self.__smoothed = value
+
+        if self.__reported is not None:
+            if value == self.__reported or abs(value - self.__reported) < self.__deadband or now - self.__reported_time < self.__min_interval:
+                return value, False
+        self.__reported = value
+        self.__reported_time = now
+        return value, True
+
+
+class Hysteresis:
+    # on above on_above, off below off_below, unchanged in between
+    __slots__ = ("__on_above", "__off_below", "state")
+
+    def __init__(self, on_above, off_below, state=0):
+        self.__on_above                     = on_above
+        self.__off_below                    = off_below
+        self.state                          = state
+
+    def update(self, value):
+        # returns the new state, or None if it didn't change
+        if value > self.__on_above and self.state == 0:
+            self.state = 1
+            return 1
+        if value < self.__off_below and self.state == 1:
+            self.state = 0
+            return 0
+        return None
+
+
+# dht22 reads can fail, glitch or drift by a tenth of a degree between reads, the cpu temp jitters
+DEFAULT_FILTERS = dict(
+    cpu_temp        = dict(valid=(-40, 250), median=3, deadband=2, min_interval=600),
+    room_temp       = dict(valid=(-40, 176), max_step=10, median=3, deadband=.5, min_interval=600),
+    humidity        = dict(valid=(0, 100), max_step=20, median=3, deadband=2, min_interval=600),
+)
+
+
+def load_filters(config):
+    # feed id -> SensorFilter, keyed by feed name in config like everything else.
+    # feeds without a filter only drop failed reads and report every change
+    filters = dict((name, SensorFilter(**settings)) for name, settings in getattr(config, 'sensor_filters', DEFAULT_FILTERS).items())
+    return dict((feed, filters.get(name) or SensorFilter()) for name, feed in config.feeds.items())
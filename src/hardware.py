@@ -0,0 +1,212 @@
+import logging
+import threading
+from src.actuators import ActuatorScheduler
+from src.inputs import InputEngine
+from src.sensors import SensorScheduler
+
+
+class Hardware:
+    # the pins: relays, switches, contacts, lock motors, the cpu fan and the sensors. a wall switch toggles its
+    # relay right here, everything that changed is handed to on_events as [(kind, name, value), ..] holding lock
+    #   ("switch", relay, level)    ("relay", relay, state)     ("contact", contact, level)
+    #   ("lock", lock, state)       ("cpu_fan", "cpu_fan", state)                   ("sensor", sensor, reading)
+    __DHT_TIMEOUT                           = 15                # seconds spent retrying a failed read
+    __DHT_RETRY_DELAY                       = 2                 # seconds, dht22 can't be read more often
+    __LOCK_MOTOR_PULSE                      = .2                # seconds
+
+    def __init__(self, backend, config, devices, lock=None, cpu_fan_state=0):
+        self.__backend                      = backend
+        self.__gpio                         = backend.gpio
+        self.__devices                      = devices
+        self.__relays                       = dict((relay.name, relay) for relay in devices.relays)
+        self.__locks                        = dict((lock.name, lock) for lock in devices.locks)
+        self.__cpu_fan_pin                  = config.pins['cpu_fan_enable']
+        self.__cpu_fan_state                = cpu_fan_state
+        self.__lock                         = lock if lock is not None else threading.RLock()
+        self.__on_events                    = None
+
+        self.__logger                       = logging.getLogger(__name__)
+
+        self.__gpio.setmode(self.__gpio.BOARD)
+        self.__gpio.setwarnings(False)
+        # relays come up in their restored state (active low), motors stopped
+        for relay in devices.relays:
+            self.__gpio.setup(relay.relay_pin, self.__gpio.OUT, initial=int(not relay.state))
+        for lock in devices.locks:
+            self.__gpio.setup(lock.in_1_pin, self.__gpio.OUT)
+            self.__gpio.setup(lock.in_2_pin, self.__gpio.OUT)
+            self.__gpio.setup(lock.enable_pin, self.__gpio.OUT, initial=self.__gpio.LOW)
+        self.__gpio.setup(self.__cpu_fan_pin, self.__gpio.OUT, initial=cpu_fan_state)
+
+        # timed outputs (lock motor pulses) share one timer thread
+        self.__actuators = ActuatorScheduler()
+
+        # edge triggered inputs by device name, debounce (milliseconds) can be overridden per pin in config
+        self.__input_handlers = {}
+        self.__inputs = InputEngine(self.__gpio)
+        for relay in devices.relays:
+            self.__input_handlers[relay.name] = lambda level, relay=relay: self.__handle_switch_change(relay, level)
+            self.__inputs.add_input(relay.name, relay.switch_pin, relay.debounce)
+        for contact in devices.contacts:
+            self.__input_handlers[contact.name] = lambda level, contact=contact: [("contact", contact.name, level)]
+            self.__inputs.add_input(contact.name, contact.pin, contact.debounce)
+
+        # relays are already restored, only flipping a switch from here on toggles them
+        for relay in devices.relays:
+            relay.switch_level = self.__gpio.input(relay.switch_pin)
+
+        self.__sensors = SensorScheduler()
+
+    def start(self, on_events):
+        # inputs that changed since the pins were set up are handed over too
+        self.__on_events = on_events
+
+        # sensors are sampled on worker threads, readings are handled on their own thread as they arrive
+        for sensor in self.__devices.sensors:
+            if sensor.kind == 'dht22':
+                self.__sensors.add_sensor(sensor.name, self.__dht_reader(sensor.pin), sensor.interval,
+                                          self.__DHT_TIMEOUT, self.__DHT_RETRY_DELAY)
+            else:
+                self.__sensors.add_sensor(sensor.name, self.__read_cpu_temp, sensor.interval)
+
+        self.__input_thread = threading.Thread(target=self.__handle_input_events, name="input-events", daemon=True)
+        self.__input_thread.start()
+        self.__sensor_thread = threading.Thread(target=self.__handle_sensor_events, name="sensor-events", daemon=True)
+        self.__sensor_thread.start()
+    def set_relay(self, name, state):
+        with self.__lock:
+            relay = self.__relays[name]
+            if relay.state != state:
+                self.__on_events(self.__change_relay_state(relay, state))
+    def pulse_lock(self, name, lock_state):
+        # motor is switched off by the actuator thread, nothing here blocks
+        with self.__lock:
+            lock = self.__locks[name]
+            self.__actuators.pulse(lock.name, lambda: self.__start_lock_motor(lock, lock_state), lambda: self.__stop_lock_motor(lock),
+                                   self.__LOCK_MOTOR_PULSE)
+            self.__on_events([("lock", lock.name, lock_state)])
+    def set_cpu_fan(self, cpu_fan_state):
+        with self.__lock:
+            if self.__cpu_fan_state != cpu_fan_state:
+                self.__cpu_fan_state = cpu_fan_state
+                self.__gpio.output(self.__cpu_fan_pin, cpu_fan_state)
+                self.__on_events([("cpu_fan", "cpu_fan", cpu_fan_state)])
+    def qsize(self):
+        return self.__inputs.qsize()
+
+    @staticmethod
+    def __to_fahrenheit(celsius):
+        return celsius *9/5.+32
+    def __read_cpu_temp(self):
+        # converted on the sensor thread, None still means the read failed
+        cpu_temp = self.__backend.read_cpu_temp()
+        return None if cpu_temp is None else (self.__to_fahrenheit(cpu_temp), )
+    def __dht_reader(self, pin):
+        def read_dht():
+            reading = self.__backend.read_dht(pin)
+            return None if reading is None else (reading[0], self.__to_fahrenheit(reading[1]))
+        return read_dht
+
+    def __change_relay_state(self, relay, state):
+        relay.state = state
+        self.__gpio.output(relay.relay_pin, int(not state))
+        return [("relay", relay.name, state)]
+    def __start_lock_motor(self, lock, lock_state):
+        # stop before changing direction in case a previous pulse is still running
+        self.__gpio.output(lock.enable_pin, self.__gpio.LOW)
+        self.__gpio.output(lock.in_1_pin, lock_state)
+        self.__gpio.output(lock.in_2_pin, int(not lock_state))
+        self.__gpio.output(lock.enable_pin, self.__gpio.HIGH)
+    def __stop_lock_motor(self, lock):
+        self.__gpio.output(lock.enable_pin, self.__gpio.LOW)
+    def __handle_switch_change(self, relay, switch_level):
+        if switch_level == relay.switch_level:
+            return []
+        relay.switch_level = switch_level
+        return [("switch", relay.name, switch_level)] + self.__change_relay_state(relay, int(not relay.state))
+    def __handle_input_events(self):
+        while True:
+            changes = self.__inputs.get()
+            # one lock for every input that settled together, their events go out as one batch
+            with self.__lock:
+                events = []
+                for input_name, level in changes:
+                    try:
+                        events.extend(self.__input_handlers[input_name](level))
+                    except Exception:
+                        self.__logger.exception("")
+                if events:
+                    self.__on_events(events)
+    def __handle_sensor_events(self):
+        while True:
+            sensor_name, reading = self.__sensors.get()
+            with self.__lock:
+                self.__on_events([("sensor", sensor_name, reading)])
+
+
+class HardwareClient:
+    # the hardware process seen from the network side, the same calls as Hardware over a pair of shared rings
+    def __init__(self, commands, events, states):
+        self.__commands                     = commands          # ring of (kind, name, value) to the hardware process
+        self.__events                       = events            # ring of event batches from it
+        self.__states                       = states            # relay and cpu fan states it keeps up to date
+
+        self.__logger                       = logging.getLogger(__name__)
+
+    def start(self, on_events):
+        self.__event_thread = threading.Thread(target=self.__handle_events_forever, args=(on_events, ), name="hardware-events", daemon=True)
+        self.__event_thread.start()
+    def relay_state(self, name):
+        return self.__states[name]
+    def set_relay(self, name, state):
+        self.__command("relay", name, state)
+    def pulse_lock(self, name, lock_state):
+        self.__command("lock", name, lock_state)
+    def set_cpu_fan(self, cpu_fan_state):
+        self.__command("cpu_fan", "cpu_fan", cpu_fan_state)
+    def qsize(self):
+        return self.__events.qsize()
+
+    def __command(self, kind, name, value):
+        # a hardware process being restarted catches up on the ring, it's only full if it's been gone a long while
+        if not self.__commands.put((kind, name, value)):
+            self.__logger.warning("hardware commands full, {} {} -> {} dropped".format(kind, name, value))
+    def __handle_events_forever(self, on_events):
+        while True:
+            for events in self.__events.get():
+                on_events(events)
+
+
+def run_hardware(backend, config, devices, commands, events, states):
+    # the hardware process: pins come back the way states left them, changes go out over events and are mirrored
+    # into states under the hardware lock so a restart of either side finds them where they were
+    logger = logging.getLogger(__name__)
+    for relay in devices.relays:
+        relay.state = states[relay.name]
+
+    full = [False]
+    def put_events(changes):
+        for kind, name, value in changes:
+            if kind in ("relay", "cpu_fan"):
+                states[name] = value
+        if events.put(changes):
+            full[0] = False
+        elif not full[0]:
+            # the network side is down or stuck, the relays keep working without it
+            full[0] = True
+            logger.warning("hardware events full, dropped until the network side catches up")
+
+    hardware = Hardware(backend, config, devices, cpu_fan_state=states["cpu_fan"])
+    hardware.start(put_events)
+
+    handlers = {
+        "relay":                            hardware.set_relay,
+        "lock":                             hardware.pulse_lock,
+        "cpu_fan":                          lambda name, cpu_fan_state: hardware.set_cpu_fan(cpu_fan_state),
+    }
+    while True:
+        for kind, name, value in commands.get():
+            try:
+                handlers[kind](name, value)
+            except Exception:
+                logger.exception("")
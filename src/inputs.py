@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+
+
+class InputEngine:
+    __DEFAULT_DEBOUNCE                      = 50                # milliseconds
+
+    def __init__(self, gpio):
+        self.__gpio                         = gpio              # RPi.GPIO or a simulation of it
+        self.__events                       = queue.Queue()
+        self.__cond                         = threading.Condition()
+
+        self.__names                        = {}                # pin -> input name
+        self.__debounce                     = {}                # pin -> seconds
+        self.__levels                       = {}                # pin -> last reported level
+        self.__pending                      = {}                # pin -> time the pin is read next, edges before then are ignored
+        self.__rereads                      = set()             # pins whose pending read ends a debounce window
+
+        self.__worker = threading.Thread(target=self.__settle_forever, name="inputs", daemon=True)
+        self.__worker.start()
+
+    def add_input(self, name, pin, debounce=None):
+        if debounce is None:
+            debounce = self.__DEFAULT_DEBOUNCE
+
+        self.__gpio.setup(pin, self.__gpio.IN, pull_up_down=self.__gpio.PUD_UP)
+        with self.__cond:
+            self.__names[pin] = name
+            self.__debounce[pin] = debounce / 1000.
+            self.__levels[pin] = -1
+
+            # report the current level right away so the initial state gets handled
+            self.__pending[pin] = time.monotonic()
+            self.__cond.notify()
+        self.__gpio.add_event_detect(pin, self.__gpio.BOTH, callback=self.__on_edge)
+
+    def get(self, timeout=None):
+        # blocks until inputs change, returns [(name, level), ..] for every pin that settled together
+        return self.__events.get(timeout=timeout)
+    def qsize(self):
+        return self.__events.qsize()
+
+    def __on_edge(self, pin):
+        # called from the RPi.GPIO event thread. the first edge is read right away, the bounce after a change is
+        # ignored until the pin is read again at the end of the debounce window
+        with self.__cond:
+            if pin not in self.__pending:
+                self.__pending[pin] = time.monotonic()
+                self.__cond.notify()
+    def __settle_forever(self):
+        while True:
+            with self.__cond:
+                while not self.__pending:
+                    self.__cond.wait()
+
+                now = time.monotonic()
+                due = [pin for pin, read_time in self.__pending.items() if read_time <= now]
+                if not due:
+                    self.__cond.wait(min(self.__pending.values()) - now)
+                    continue
+                for pin in due:
+                    if pin in self.__rereads:
+                        self.__rereads.discard(pin)
+                        del self.__pending[pin]
+                    else:
+                        # the window starts at the first edge, the pin is read again once it's over
+                        self.__pending[pin] = now + self.__debounce[pin]
+                        self.__rereads.add(pin)
+
+            # every due pin is read in one pass and handed over as one batch
+            changes = []
+            changed_pins = []
+            for pin in due:
+                level = self.__gpio.input(pin)
+                if level != self.__levels[pin]:
+                    self.__levels[pin] = level
+                    changes.append((self.__names[pin], level))
+                    changed_pins.append(pin)
+            if changes:
+                self.__events.put(changes)
+
+            # a pin that changed again by the end of its window starts a new one
+            with self.__cond:
+                now = time.monotonic()
+                for pin in changed_pins:
+                    if pin not in self.__rereads:
+                        self.__pending[pin] = now + self.__debounce[pin]
+                        self.__rereads.add(pin)
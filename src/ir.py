@@ -0,0 +1,121 @@
+import logging
+import queue
+import socket
+import threading
+
+
+class LircError(Exception):
+    pass
+
+
+class IRTransmitter:
+    __SOCKET_PATH                           = "/var/run/lirc/lircd"
+    __TIMEOUT                               = 2                 # seconds to wait for lircd to reply
+    __REPEAT_TIME                           = .15               # seconds lircd takes to transmit each repeat before replying
+    __MAX_REPEAT                            = 10                # presses sent as one command
+    __REPEATABLE_KEYS                       = ("volume_up", "volume_down", "arrow_up", "arrow_down", "arrow_left", "arrow_right")
+
+    def __init__(self, remote, socket_path=__SOCKET_PATH, repeatable_keys=__REPEATABLE_KEYS):
+        self.__remote                       = remote
+        self.__socket_path                  = socket_path
+        self.__repeatable_keys              = set(repeatable_keys)  # held down is the same as pressed again
+        self.__sock                         = None
+        self.__file                         = None
+
+        self.__logger                       = logging.getLogger(__name__)
+        self.__queue                        = queue.Queue()     # keys, sent in strict fifo order
+
+        self.__worker = threading.Thread(target=self.__send_forever, name="ir", daemon=True)
+        self.__worker.start()
+
+    def send(self, key):
+        self.__queue.put(key)
+    def qsize(self):
+        return self.__queue.qsize()
+
+    def __connect(self):
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__sock.settimeout(self.__TIMEOUT)
+        self.__sock.connect(self.__socket_path)
+        self.__file = self.__sock.makefile("r")
+    def __close(self):
+        if self.__sock is not None:
+            self.__file.close()
+            self.__sock.close()
+        self.__sock = None
+        self.__file = None
+
+    def __readline(self):
+        line = self.__file.readline()
+        if not line:
+            raise ConnectionError("lircd closed the connection")
+        return line.strip()
+    def __read_reply(self, command):
+        # BEGIN, the command echoed back, SUCCESS or ERROR, optional DATA, END
+        while True:
+            # lircd also broadcasts decoded button presses and SIGHUP to every client, skip them
+            if self.__readline() != "BEGIN":
+                continue
+            lines = []
+            line = self.__readline()
+            while line != "END":
+                lines.append(line)
+                line = self.__readline()
+            if not lines or lines[0] != command:
+                continue
+
+            if len(lines) > 1 and lines[1] == "ERROR":
+                raise LircError("{}: {}".format(command, " ".join(lines[4:])))
+            return
+    def __send(self, key, count):
+        # repeated keys go out as one command, lircd sends the key once plus the repeat count
+        command = "SEND_ONCE {} {}".format(self.__remote, key)
+        if count > 1:
+            command += " {}".format(count-1)
+
+        for attempt in range(2):
+            try:
+                if self.__sock is None:
+                    self.__connect()
+                # lircd only replies once it's done transmitting
+                self.__sock.settimeout(self.__TIMEOUT + (count-1) * self.__REPEAT_TIME)
+                self.__sock.sendall((command + "\n").encode())
+                break
+            except OSError:
+                # lircd restarted or the connection went stale, reconnect once
+                self.__close()
+        else:
+            self.__logger.error("could not send {} to lircd at {}".format(command, self.__socket_path))
+            return
+
+        # the command is out, sending it again could press the key twice
+        try:
+            self.__read_reply(command)
+        except LircError:
+            self.__logger.exception("")
+        except OSError:
+            self.__logger.exception("no reply from lircd to {}".format(command))
+            self.__close()
+    def __send_forever(self):
+        key = self.__queue.get()
+        while True:
+            # collapse back to back presses of a repeatable key (volume ramps), anything else is pressed once per send
+            count = 1
+            next_key = None
+            if key in self.__repeatable_keys:
+                while count < self.__MAX_REPEAT:
+                    try:
+                        next_key = self.__queue.get_nowait()
+                    except queue.Empty:
+                        next_key = None
+                        break
+                    if next_key != key:
+                        break
+                    count += 1
+                    next_key = None
+
+            self.__send(key, count)
+
+            if next_key is None:
+                next_key = self.__queue.get()
+            key = next_key
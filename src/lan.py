@@ -0,0 +1,170 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import struct
+import threading
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class LanServer:
+    # http and websocket control on the local network, the same operations as the adafruit io feeds
+    #   GET  /state               {feed id: latest value}
+    #   POST /feeds/<feed id>     body is the payload, exactly what adafruit io would send
+    #   GET  /ws                  websocket, {"state": {..}} then {"feed": .., "value": ..} per change,
+    #                             {"feed": .., "payload": ..} messages are commands
+    __WEBSOCKET_GUID                        = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    __MAX_MESSAGE                           = 64 * 1024         # bytes, requests and websocket messages
+    __MAX_BUFFERED                          = 256 * 1024        # bytes queued to a websocket before it's dropped
+    __REASONS                               = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found"}
+
+    def __init__(self, command, token):
+        self.__command                      = command           # (feed id, payload) -> False if the feed can't be commanded
+        self.__token                        = token             # required on every request, as a bearer token or ?token=
+        self.__states                       = {}                # feed id -> latest value, only touched on the loop thread
+        self.__websockets                   = set()             # writers of connected websockets
+        self.__loop                         = asyncio.new_event_loop()
+
+        self.__logger                       = logging.getLogger(__name__)
+
+    def serve(self, port, address=""):
+        # binds here so a port already in use raises to the caller, then runs the event loop on its own thread.
+        # port 0 picks a free one, returns the port
+        server = self.__loop.run_until_complete(asyncio.start_server(self.__handle_connection, address or None, port))
+        thread = threading.Thread(target=self.__loop.run_forever, name="lan", daemon=True)
+        thread.start()
+        return server.sockets[0].getsockname()[1]
+    def notify(self, feed, value):
+        # called from any thread whenever a feed changes, pushed to every websocket
+        self.__loop.call_soon_threadsafe(self.__update, feed, value)
+    def clients(self):
+        return len(self.__websockets)
+
+    def __update(self, feed, value):
+        self.__states[feed] = value
+        frame = self.__frame(json.dumps(dict(feed=feed, value=value)))
+        for writer in list(self.__websockets):
+            # a client that stopped reading isn't allowed to pile up memory
+            if writer.transport.get_write_buffer_size() > self.__MAX_BUFFERED:
+                self.__websockets.discard(writer)
+                writer.close()
+            else:
+                writer.write(frame)
+
+    async def __handle_connection(self, reader, writer):
+        try:
+            method, path, headers, body = await self.__read_request(reader)
+            url = urlsplit(path)
+            if not self.__authorized(url, headers):
+                self.__respond(writer, 401, dict(error="unauthorized"))
+            elif url.path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self.__websocket(reader, writer, headers)
+            elif method == "GET" and url.path == "/state":
+                self.__respond(writer, 200, self.__states)
+            elif method == "POST" and url.path.startswith("/feeds/"):
+                feed = unquote(url.path[len("/feeds/"):])
+                payload = body.decode()
+                if await self.__run_command(feed, payload):
+                    self.__respond(writer, 200, dict(feed=feed, payload=payload))
+                else:
+                    self.__respond(writer, 404, dict(error="unknown feed {}".format(feed)))
+            else:
+                self.__respond(writer, 404, dict(error="not found"))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, KeyError, ValueError):
+            pass
+        except Exception:
+            self.__logger.exception("")
+        finally:
+            self.__websockets.discard(writer)
+            writer.close()
+    async def __read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise ValueError("bad request line")
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > self.__MAX_MESSAGE:
+            raise ValueError("request too large")
+        body = await reader.readexactly(length) if length else b""
+        return request_line[0], request_line[1], headers, body
+    def __authorized(self, url, headers):
+        authorization = headers.get("authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):]
+        else:
+            token = parse_qs(url.query).get("token", [""])[0]
+        return hmac.compare_digest(token.encode(), self.__token.encode())
+    def __respond(self, writer, status, body):
+        body = json.dumps(body).encode()
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                     .format(status, self.__REASONS[status], len(body)).encode() + body)
+    async def __run_command(self, feed, payload):
+        # handlers take the space lock, keep them off the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, self.__command, feed, payload) is not False
+
+    async def __websocket(self, reader, writer, headers):
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + self.__WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n"
+                     .format(accept).encode())
+        writer.write(self.__frame(json.dumps(dict(state=self.__states))))
+        self.__websockets.add(writer)
+
+        message = b""
+        while True:
+            fin, opcode, payload = await self.__read_frame(reader)
+            if opcode == 0x8:
+                writer.write(self.__frame(payload, 0x8))
+                return
+            if opcode == 0x9:
+                writer.write(self.__frame(payload, 0xA))
+                continue
+            if opcode not in (0x0, 0x1):
+                continue
+            message += payload
+            if len(message) > self.__MAX_MESSAGE:
+                raise ValueError("message too large")
+            if not fin:
+                continue
+
+            try:
+                command = json.loads(message.decode())
+                feed, payload = command["feed"], str(command["payload"])
+            except (ValueError, KeyError, TypeError):
+                writer.write(self.__frame(json.dumps(dict(error="expected {\"feed\": .., \"payload\": ..}"))))
+            else:
+                if not await self.__run_command(feed, payload):
+                    writer.write(self.__frame(json.dumps(dict(error="unknown feed {}".format(feed)))))
+            message = b""
+    async def __read_frame(self, reader):
+        head = await reader.readexactly(2)
+        length = head[1] & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+        if length > self.__MAX_MESSAGE:
+            raise ValueError("frame too large")
+        # clients always mask their frames
+        mask = await reader.readexactly(4) if head[1] & 0x80 else b"\0\0\0\0"
+        payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(await reader.readexactly(length)))
+        return head[0] & 0x80, head[0] & 0x0f, payload
+    @staticmethod
+    def __frame(payload, opcode=0x1):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x80 | opcode, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, len(payload))
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, len(payload))
+        return header + payload
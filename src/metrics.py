@@ -0,0 +1,129 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class Counter:
+    def __init__(self):
+        self.__value                        = 0
+        self.__lock                         = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value += amount
+    def samples(self):
+        return [("", (), self.__value)]
+
+
+class Callback:
+    # value is read when scraped, nothing is tracked in between
+    def __init__(self, read):
+        self.__read                         = read
+
+    def samples(self):
+        return [("", (), self.__read())]
+
+
+class Histogram:
+    __BUCKETS                               = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)   # seconds
+
+    def __init__(self, buckets=__BUCKETS):
+        self.__buckets                      = buckets
+        self.__counts                       = [0] * (len(buckets) + 1)
+        self.__sum                          = 0.
+        self.__lock                         = threading.Lock()
+
+    def observe(self, seconds):
+        # one bucket increment per observation, cumulative counts are only built when scraped
+        index = bisect.bisect_left(self.__buckets, seconds)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += seconds
+    def timed(self, function):
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - start)
+        return timed_function
+    def samples(self):
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__sum
+
+        samples = []
+        cumulative = 0
+        for bucket, count in zip(list(self.__buckets) + ["+Inf"], counts):
+            cumulative += count
+            samples.append(("_bucket", (("le", str(bucket)), ), cumulative))
+        samples.append(("_sum", (), total))
+        samples.append(("_count", (), cumulative))
+        return samples
+
+
+class Metrics:
+    def __init__(self):
+        self.__families                     = OrderedDict()     # name -> [type, help, OrderedDict(labels -> metric)]
+        self.__lock                         = threading.Lock()
+        self.__server                       = None
+
+    def counter(self, name, help, **labels):
+        return self.__register(name, "counter", help, labels, Counter)
+    def histogram(self, name, help, **labels):
+        return self.__register(name, "histogram", help, labels, Histogram)
+    def callback(self, name, kind, help, read, **labels):
+        # kind is "gauge" or "counter"
+        return self.__register(name, kind, help, labels, lambda: Callback(read))
+
+    def render(self):
+        # prometheus text exposition format
+        lines = []
+        with self.__lock:
+            families = [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in self.__families.items()]
+        for name, kind, help, metrics in families:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, metric in metrics:
+                for suffix, extra_labels, value in metric.samples():
+                    label_text = ",".join('{}="{}"'.format(key, value) for key, value in labels + extra_labels)
+                    if label_text:
+                        label_text = "{" + label_text + "}"
+                    lines.append("{}{}{} {}".format(name, suffix, label_text, value))
+        return "\n".join(lines) + "\n"
+    def serve(self, port, address=""):
+        # scrape endpoint at http://<pi>:<port>/metrics, port 0 picks a free one, returns the port
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+
+        class MetricsServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.__server = MetricsServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=self.__server.serve_forever, name="metrics", daemon=True)
+        thread.start()
+        return self.__server.server_address[1]
+
+    def __register(self, name, kind, help, labels, create):
+        labels = tuple(sorted(labels.items()))
+        with self.__lock:
+            family = self.__families.setdefault(name, [kind, help, OrderedDict()])
+            if labels not in family[2]:
+                family[2][labels] = create()
+            return family[2][labels]
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Publisher:
+    __RATE_LIMIT                            = 30                # messages per minute (adafruit io free tier)
+    __BURST                                 = 5                 # messages sent back to back before throttling
+    __RECONNECT_WAIT                        = 1                 # seconds
+
+    def __init__(self, client, priority_feeds=(), rate_limit=__RATE_LIMIT, burst=__BURST, outbox=None):
+        self.__client                       = client
+        self.__priority_feeds               = set(priority_feeds)
+        self.__outbox                       = outbox            # db, keeps values across outages and restarts
+        self.__online                       = False
+
+        # latest value wins, one pending slot per feed in the order feeds were first queued
+        self.__priority                     = OrderedDict()     # actuator state feeds
+        self.__telemetry                    = OrderedDict()     # sensor feeds
+        self.__cond                         = threading.Condition()
+
+        # token bucket, a full bucket plus a minute of refill never goes over rate_limit
+        self.__burst                        = max(min(burst, rate_limit // 2), 1)
+        self.__rate                         = max(rate_limit - self.__burst, 1) / 60.  # tokens per second
+        self.__tokens                       = float(burst)
+        self.__token_time                   = time.monotonic()
+
+        self.__published                    = 0
+        self.__coalesced                    = 0
+        self.__dropped                      = 0
+
+        self.__worker = threading.Thread(target=self.__publish_forever, name="publisher", daemon=True)
+        self.__worker.start()
+
+    def publish(self, feed, value):
+        # never blocks, the value replaces anything still waiting for the same feed
+        with self.__cond:
+            self.__queue(feed, value)
+            self.__cond.notify()
+    def stats(self):
+        with self.__cond:
+            return dict(
+                depth                       = len(self.__priority) + len(self.__telemetry),
+                published                   = self.__published,
+                coalesced                   = self.__coalesced,
+                dropped                     = self.__dropped,
+            )
+
+    def __queue(self, feed, value):
+        pending = self.__priority if feed in self.__priority_feeds else self.__telemetry
+        if feed in pending:
+            self.__coalesced += 1
+        pending[feed] = value
+    def __go_offline(self):
+        # park pending values in the outbox, the latest one per feed survives a restart
+        self.__online = False
+        if self.__outbox is None:
+            return
+        with self.__cond:
+            pending = list(self.__priority.items()) + list(self.__telemetry.items())
+            self.__priority.clear()
+            self.__telemetry.clear()
+        for feed, value in pending:
+            self.__outbox.outbox_put(feed, value)
+    def __go_online(self):
+        # replay the outbox, values published since reconnecting are newer and win
+        self.__online = True
+        if self.__outbox is None:
+            return
+        parked = self.__outbox.outbox_take()
+        with self.__cond:
+            for feed, value in parked:
+                if feed not in self.__priority and feed not in self.__telemetry:
+                    self.__queue(feed, value)
+                else:
+                    self.__coalesced += 1
+
+    def __take_token(self):
+        while True:
+            now = time.monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now-self.__token_time) * self.__rate)
+            self.__token_time = now
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return
+            time.sleep((1-self.__tokens) / self.__rate)
+    def __publish_forever(self):
+        while True:
+            # hold on to pending values until the client is back
+            if not self.__client.is_connected():
+                self.__go_offline()
+                time.sleep(self.__RECONNECT_WAIT)
+                continue
+            if not self.__online:
+                self.__go_online()
+
+            with self.__cond:
+                if not self.__priority and not self.__telemetry:
+                    # wake up now and then to notice the connection dropping
+                    self.__cond.wait(self.__RECONNECT_WAIT)
+                    continue
+
+            self.__take_token()
+            if not self.__client.is_connected():
+                continue
+            with self.__cond:
+                pending = self.__priority or self.__telemetry
+                feed, value = pending.popitem(last=False)
+
+            try:
+                self.__client.publish(feed, value)
+            except Exception:
+                with self.__cond:
+                    self.__dropped += 1
+            else:
+                with self.__cond:
+                    self.__published += 1
@@ -0,0 +1,163 @@
+import logging
+import time
+from src.filters import Hysteresis
+
+
+class Rule:
+    __slots__ = ("name", "feed", "at", "condition", "band", "edge", "window", "then", "otherwise", "active", "timed")
+
+    def __init__(self, name, feed, at, condition, band, edge, window, then, otherwise):
+        self.name                           = name
+        self.feed                           = feed              # feed id the rule is indexed under, None for time of day rules
+        self.at                             = at                # (hour, minute) the rule fires every day, or None
+        self.condition                      = condition         # value -> bool, keeps its own state between events
+        self.band                           = band              # hysteresis behind an above/below condition
+        self.edge                           = edge              # fire when the condition turns true (or false), not on every event
+        self.window                         = window            # (start, end) times of day the rule is armed, or None
+        self.then                           = then              # (feed id, payload)
+        self.otherwise                      = otherwise         # (feed id, payload) when the condition turns false, or None
+        self.active                         = False
+        self.timed                          = None              # histogram, set by the engine
+
+
+class RuleEngine:
+    __MAX_DEPTH                             = 4                 # actions triggering rules triggering actions..
+
+    def __init__(self, actions, metrics=None):
+        self.__actions                      = actions           # feed id -> payload handler, same as a message from adafruit io
+        self.__metrics                      = metrics
+        self.__index                        = {}                # feed id -> rules that depend on it
+        self.__rules                        = {}                # name -> rule
+        self.__depth                        = 0
+
+        self.__logger                       = logging.getLogger(__name__)
+
+    def load(self, rules):
+        # compiles every rule before swapping them in so a bad one keeps the old set, returns the time of day rules
+        compiled = [self.__compile(settings) for settings in rules]
+        index = {}
+        for rule in compiled:
+            # a reloaded rule picks up where it left off, a fan it turned on still gets turned off
+            prev_rule = self.__rules.get(rule.name)
+            if prev_rule is not None and rule.edge:
+                rule.active = prev_rule.active
+                if rule.band is not None:
+                    rule.band.state = int(rule.active)
+            if rule.feed is not None:
+                index.setdefault(rule.feed, []).append(rule)
+            if self.__metrics is not None:
+                rule.timed = self.__metrics.histogram("space_rule_seconds", "Time spent evaluating each rule", rule=rule.name)
+        self.__index = index
+        self.__rules = dict((rule.name, rule) for rule in compiled)
+        return [rule for rule in compiled if rule.at is not None]
+    def update(self, feed, value, now):
+        # only rules that depend on feed are evaluated, now is the local datetime
+        rules = self.__index.get(feed)
+        if not rules or value is None:
+            return
+        if self.__depth >= self.__MAX_DEPTH:
+            self.__logger.warning("rules nested too deep at {}, not evaluated".format(feed))
+            return
+
+        self.__depth += 1
+        try:
+            for rule in rules:
+                start = time.perf_counter()
+                try:
+                    self.__evaluate(rule, value, now)
+                except Exception:
+                    self.__logger.exception(rule.name)
+                if rule.timed is not None:
+                    rule.timed.observe(time.perf_counter() - start)
+        finally:
+            self.__depth -= 1
+    def fire(self, rule, now):
+        # a time of day rule came due
+        if not self.__in_window(rule, now):
+            return
+        try:
+            self.__run(rule, rule.then)
+        except Exception:
+            self.__logger.exception(rule.name)
+
+    def __evaluate(self, rule, value, now):
+        active = rule.condition(value) and self.__in_window(rule, now)
+        if not rule.edge:
+            if active:
+                self.__run(rule, rule.then)
+        elif active and not rule.active:
+            rule.active = True
+            self.__run(rule, rule.then)
+        elif not active and rule.active:
+            rule.active = False
+            if rule.otherwise is not None:
+                self.__run(rule, rule.otherwise)
+    def __run(self, rule, action):
+        self.__logger.info("rule {} -> {} {}".format(rule.name, *action))
+        feed, payload = action
+        self.__actions[feed](payload)
+    @staticmethod
+    def __in_window(rule, now):
+        if rule.window is None:
+            return True
+        start, end = rule.window
+        cur = (now.hour, now.minute)
+        # a window can wrap past midnight
+        return start <= cur < end if start <= end else cur >= start or cur < end
+
+    @staticmethod
+    def __time_of_day(text):
+        hour, minute = text.split(":")
+        return int(hour), int(minute)
+    def __compile(self, settings):
+        name = settings['name']
+        at = self.__time_of_day(settings['at']) if 'at' in settings else None
+        window = tuple(self.__time_of_day(text) for text in settings['between']) if 'between' in settings else None
+        then = (settings['then']['feed'], settings['then']['payload'])
+        otherwise = (settings['otherwise']['feed'], settings['otherwise']['payload']) if 'otherwise' in settings else None
+        feed = settings.get('feed')
+        if at is None and feed is None:
+            raise ValueError("rule {} needs a feed or a time".format(name))
+        # only feeds that take commands can be acted on, a sensor feed would fail every time the rule fires
+        for action in (then, otherwise):
+            if action is not None and action[0] not in self.__actions:
+                raise ValueError("rule {} can't act on feed {}".format(name, action[0]))
+
+        edge = True
+        band = None
+        if 'above' in settings or 'below' in settings:
+            # true above the threshold and false only once back below off_below (the threshold by default),
+            # below is the same band mirrored
+            sign = 1 if 'above' in settings else -1
+            threshold = settings['above'] if sign == 1 else settings['below']
+            band = Hysteresis(sign * threshold, sign * settings.get('off_below' if sign == 1 else 'off_above', threshold))
+            def condition(value):
+                band.update(sign * value)
+                return band.state == 1
+        elif 'equals' in settings:
+            target = settings['equals']
+            condition = lambda value: value == target
+        else:
+            # every change, optionally only changes to a value
+            edge = False
+            last = [None]
+            target = settings.get('to')
+            def condition(value):
+                changed = value != last[0]
+                last[0] = value
+                return changed and (target is None or value == target)
+        return Rule(name, feed, at, condition, band, edge, window, then, otherwise)
+
+
+def resolve_rules(rules, feeds):
+    # rules in config name their feeds like the device registry does, the engine works on feed ids
+    resolved = []
+    for settings in rules:
+        settings = dict(settings)
+        if 'feed' in settings:
+            settings['feed'] = feeds[settings['feed']]
+        for action in ('then', 'otherwise'):
+            if action in settings:
+                settings[action] = dict(settings[action], feed=feeds[settings[action]['feed']])
+        resolved.append(settings)
+    return resolved
@@ -0,0 +1,75 @@
+import os
+import queue
+import re
+import threading
+import time
+from subprocess import Popen, PIPE
+
+
+class CpuTemp:
+    __THERMAL_ZONE                          = "/sys/class/thermal/thermal_zone0/temp"
+
+    def __init__(self):
+        # keep the sysfs file open and re-read it instead of forking vcgencmd every time
+        self.__file = None
+        if os.path.exists(self.__THERMAL_ZONE):
+            self.__file = open(self.__THERMAL_ZONE)
+
+    def read(self):
+        # celsius, same resolution vcgencmd reports
+        if self.__file is not None:
+            self.__file.seek(0)
+            return round(int(self.__file.read()) / 1000., 1)
+
+        output, error = Popen(["vcgencmd", "measure_temp"], stdout=PIPE).communicate()
+        return float(re.match(r"temp=(\d+.\d+)'C", output.decode()).group(1))
+
+
+def read_dht(pin):
+    import Adafruit_DHT                                         # git+https://github.com/adafruit/Adafruit_Python_DHT.git#egg=Adafruit_Python_DHT
+
+    # (humidity, celsius) or None if the read failed
+    humidity, room_temp = Adafruit_DHT.read(Adafruit_DHT.DHT22, pin)
+    if humidity is None or room_temp is None:
+        return None
+    return humidity, room_temp
+
+
+class SensorScheduler:
+    def __init__(self):
+        self.__events                       = queue.Queue()
+        self.__workers                      = []
+
+    def add_sensor(self, name, read, interval, timeout=0, retry_delay=0):
+        # read() is called every interval seconds on its own thread and retried while it fails
+        # (returns None or raises) until timeout seconds have passed, then (name, reading) is queued
+        worker = threading.Thread(target=self.__sample_forever, args=(name, read, interval, timeout, retry_delay),
+                                  name="sensor-{}".format(name), daemon=True)
+        worker.start()
+        self.__workers.append(worker)
+
+    def get(self, timeout=None):
+        return self.__events.get(timeout=timeout)
+
+    def __sample(self, read, timeout, retry_delay):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                reading = read()
+            except Exception:
+                reading = None
+            if reading is not None or time.monotonic() + retry_delay > deadline:
+                return reading
+            time.sleep(retry_delay)
+    def __sample_forever(self, name, read, interval, timeout, retry_delay):
+        next_time = time.monotonic()
+        while True:
+            self.__events.put((name, self.__sample(read, timeout, retry_delay)))
+
+            # stay on the original schedule no matter how long the read took
+            next_time += interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
@@ -0,0 +1,103 @@
+import pickle
+import struct
+import threading
+from multiprocessing import shared_memory                      # python 3.8+, only the split processes need it
+
+
+class SharedRing:
+    # single producer, single consumer queue of messages in shared memory. the positions live in the segment
+    # so either end can die and the process that replaces it picks up where it left off.
+    # create it before forking both ends
+    __SIZE                                  = 256 * 1024        # bytes
+    __POSITION                              = struct.Struct("<Q")
+    __LENGTH                                = struct.Struct("<I")
+    __WRITTEN                               = 0                 # header offsets: bytes and messages written by the producer,
+    __READ                                  = 8                 # bytes and messages read by the consumer, each only
+    __MESSAGES_WRITTEN                      = 16                # ever increases and is only written by its own side
+    __MESSAGES_READ                         = 24
+    __HEADER_SIZE                           = 32
+
+    def __init__(self, context, size=__SIZE):
+        self.__size                         = size
+        self.__memory                       = shared_memory.SharedMemory(create=True, size=self.__HEADER_SIZE + size)
+        self.__doorbell                     = context.Semaphore(0)  # released for every message put
+        self.__put_lock                     = threading.Lock()  # threads of the producing process take turns
+
+        self.__memory.buf[:self.__HEADER_SIZE] = bytes(self.__HEADER_SIZE)
+
+    def put(self, message):
+        # never blocks, False if the consumer fell so far behind the ring is full
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        record = self.__LENGTH.pack(len(data)) + data
+        with self.__put_lock:
+            written = self.__get(self.__WRITTEN)
+            if written - self.__get(self.__READ) + len(record) > self.__size:
+                return False
+            # the record is only visible to the consumer once the position moves past it
+            self.__write(written, record)
+            self.__set(self.__WRITTEN, written + len(record))
+            self.__set(self.__MESSAGES_WRITTEN, self.__get(self.__MESSAGES_WRITTEN) + 1)
+        self.__doorbell.release()
+        return True
+    def get(self, timeout=None):
+        # every message waiting, blocks up to timeout for the first one, [] if none came
+        if self.__get(self.__READ) == self.__get(self.__WRITTEN):
+            self.__doorbell.acquire(timeout=timeout)
+        # everything is drained at once, the releases of the other messages are stale
+        while self.__doorbell.acquire(False):
+            pass
+
+        messages = []
+        read = self.__get(self.__READ)
+        written = self.__get(self.__WRITTEN)
+        while read < written:
+            length = self.__LENGTH.unpack(self.__read(read, self.__LENGTH.size))[0]
+            messages.append(pickle.loads(self.__read(read + self.__LENGTH.size, length)))
+            read += self.__LENGTH.size + length
+        self.__set(self.__READ, read)
+        self.__set(self.__MESSAGES_READ, self.__get(self.__MESSAGES_READ) + len(messages))
+        return messages
+    def qsize(self):
+        return self.__get(self.__MESSAGES_WRITTEN) - self.__get(self.__MESSAGES_READ)
+    def close(self):
+        # by the process that created it, once both ends are gone
+        self.__memory.close()
+        self.__memory.unlink()
+
+    def __get(self, offset):
+        return self.__POSITION.unpack_from(self.__memory.buf, offset)[0]
+    def __set(self, offset, position):
+        self.__POSITION.pack_into(self.__memory.buf, offset, position)
+    def __write(self, position, data):
+        # wraps around the end of the ring
+        offset = position % self.__size
+        first = min(len(data), self.__size - offset)
+        start = self.__HEADER_SIZE + offset
+        self.__memory.buf[start:start + first] = data[:first]
+        if first < len(data):
+            self.__memory.buf[self.__HEADER_SIZE:self.__HEADER_SIZE + len(data) - first] = data[first:]
+    def __read(self, position, length):
+        offset = position % self.__size
+        first = min(length, self.__size - offset)
+        start = self.__HEADER_SIZE + offset
+        data = bytes(self.__memory.buf[start:start + first])
+        if first < length:
+            data += bytes(self.__memory.buf[self.__HEADER_SIZE:self.__HEADER_SIZE + length - first])
+        return data
+
+
+class SharedStates:
+    # one small int per name that outlives the process writing it, a byte each so every write is whole
+    def __init__(self, names):
+        self.__indexes                      = dict((name, index) for index, name in enumerate(names))
+        self.__memory                       = shared_memory.SharedMemory(create=True, size=max(len(names), 1))
+
+        self.__memory.buf[:len(names)] = bytes(len(names))
+
+    def __getitem__(self, name):
+        return self.__memory.buf[self.__indexes[name]]
+    def __setitem__(self, name, state):
+        self.__memory.buf[self.__indexes[name]] = state
+    def close(self):
+        self.__memory.close()
+        self.__memory.unlink()
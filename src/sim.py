@@ -0,0 +1,240 @@
+import os
+import queue
+import random
+import socket
+import tempfile
+import threading
+import time
+from src.backends import Backend
+
+
+class SimGPIO:
+    # stands in for the RPi.GPIO module, edges are scripted with set_input()
+    BOARD, BCM                              = 10, 11
+    OUT, IN                                 = 0, 1
+    LOW, HIGH                               = 0, 1
+    PUD_OFF, PUD_DOWN, PUD_UP               = 20, 21, 22
+    RISING, FALLING, BOTH                   = 31, 32, 33
+
+    def __init__(self):
+        self.__cond                         = threading.Condition()
+        self.__levels                       = {}
+        self.__callbacks                    = {}
+        self.__outputs                      = []                # (pin, value, perf_counter time) of every write
+
+        # callbacks run on one thread like RPi.GPIO's event thread
+        self.__edges                        = queue.Queue()
+        self.__worker = threading.Thread(target=self.__fire_forever, name="sim-gpio", daemon=True)
+        self.__worker.start()
+
+    def setmode(self, mode):
+        pass
+    def setwarnings(self, warnings):
+        pass
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=None):
+        with self.__cond:
+            if direction == self.IN:
+                self.__levels.setdefault(pin, int(pull_up_down == self.PUD_UP))
+            else:
+                self.__levels[pin] = self.LOW if initial is None else initial
+    def input(self, pin):
+        with self.__cond:
+            return self.__levels[pin]
+    def output(self, pin, value):
+        with self.__cond:
+            self.__levels[pin] = int(value)
+            self.__outputs.append((pin, int(value), time.perf_counter()))
+            self.__cond.notify_all()
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.__callbacks[pin] = callback
+    def remove_event_detect(self, pin):
+        self.__callbacks.pop(pin, None)
+    def cleanup(self):
+        self.__callbacks.clear()
+
+    def set_input(self, pin, level):
+        # drive an input pin, returns when the level changed (perf_counter)
+        with self.__cond:
+            changed = self.__levels.get(pin) != level
+            self.__levels[pin] = level
+        now = time.perf_counter()
+        if changed and pin in self.__callbacks:
+            self.__edges.put(pin)
+        return now
+    def bounce(self, pin, level, edges=5, interval=.001):
+        # contact bounce ending on level, returns when the first edge hit the pin (perf_counter)
+        first = self.set_input(pin, level)
+        for edge in range(1, edges):
+            time.sleep(interval)
+            self.set_input(pin, level if edge % 2 == 0 else int(not level))
+        time.sleep(interval)
+        self.set_input(pin, level)
+        return first
+    def wait_for_output(self, pin, value, since, timeout=5):
+        # perf_counter time of the first write of value to pin after since, None on timeout
+        deadline = time.perf_counter() + timeout
+        with self.__cond:
+            while True:
+                for out_pin, out_value, out_time in self.__outputs:
+                    if out_pin == pin and out_value == value and out_time >= since:
+                        return out_time
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self.__cond.wait(remaining)
+
+    def __fire_forever(self):
+        while True:
+            pin = self.__edges.get()
+            callback = self.__callbacks.get(pin)
+            if callback is not None:
+                callback(pin)
+
+
+class FakeDHT:
+    def __init__(self, humidity=45., room_temp=21., noise=.2, fail_rate=0):
+        self.humidity                       = humidity
+        self.room_temp                      = room_temp
+        self.noise                          = noise
+        self.fail_rate                      = fail_rate
+
+    def read(self, pin):
+        if random.random() < self.fail_rate:
+            return None
+        return (self.humidity + random.uniform(-self.noise, self.noise),
+                self.room_temp + random.uniform(-self.noise, self.noise))
+
+
+class FakeThermal:
+    def __init__(self, cpu_temp=48., noise=.5):
+        self.cpu_temp                       = cpu_temp
+        self.noise                          = noise
+
+    def read(self):
+        return round(self.cpu_temp + random.uniform(-self.noise, self.noise), 1)
+
+
+class LocalBroker:
+    # in-process stand in for adafruit io
+    def __init__(self):
+        self.__lock                         = threading.Lock()
+        self.__clients                      = []
+        self.up                             = True              # set False to simulate an outage
+        self.received                       = []                # (feed, value, perf_counter time) published by clients
+
+    def attach(self, client):
+        with self.__lock:
+            self.__clients.append(client)
+    def publish(self, feed, payload):
+        # a dashboard/assistant command, delivered to every subscribed client
+        with self.__lock:
+            clients = list(self.__clients)
+        for client in clients:
+            client.deliver(feed, payload)
+    def receive(self, feed, value):
+        with self.__lock:
+            self.received.append((feed, value, time.perf_counter()))
+
+
+class SimMQTTClient:
+    # same surface as Adafruit_IO.MQTTClient, bound to a LocalBroker
+    def __init__(self, username, key, broker):
+        self.on_connect                     = None
+        self.on_disconnect                  = None
+        self.on_message                     = None
+
+        self.__broker                       = broker
+        self.__socket_up                    = False
+        self.__connected                    = False
+        self.__subscriptions                = set()
+        self.__messages                     = queue.Queue()
+
+        self.loop_gaps                      = []                # seconds spent between loop() calls
+        self.__loop_return                  = None
+
+        broker.attach(self)
+
+    def connect(self, **kwargs):
+        if self.__connected:
+            return
+        if not self.__broker.up:
+            raise OSError("broker unreachable")
+        self.__socket_up = True
+    def disconnect(self):
+        self.__socket_up = False
+    def is_connected(self):
+        return self.__connected
+    def subscribe(self, feed_id, feed_user=None):
+        self.__subscriptions.add(feed_id)
+    def publish(self, feed_id, value=None, group_id=None, feed_user=None):
+        if self.__connected:
+            self.__broker.receive(feed_id, value)
+    def loop(self, timeout_sec=1.0):
+        start = time.perf_counter()
+        if self.__loop_return is not None:
+            self.loop_gaps.append(start - self.__loop_return)
+
+        if self.__socket_up and not self.__broker.up:
+            self.__socket_up = False
+        if self.__connected and not self.__socket_up:
+            self.__connected = False
+            if self.on_disconnect is not None:
+                self.on_disconnect(self)
+        elif self.__socket_up and not self.__connected:
+            self.__connected = True
+            if self.on_connect is not None:
+                self.on_connect(self)
+
+        # like paho, wait up to timeout for traffic and handle what arrives
+        try:
+            feed_id, payload = self.__messages.get(timeout=timeout_sec)
+            while True:
+                if self.on_message is not None:
+                    self.on_message(self, feed_id, payload)
+                feed_id, payload = self.__messages.get_nowait()
+        except queue.Empty:
+            pass
+        self.__loop_return = time.perf_counter()
+
+    def deliver(self, feed_id, payload):
+        if self.__connected and feed_id in self.__subscriptions:
+            self.__messages.put((feed_id, payload))
+
+
+class FakeLircd:
+    # answers lircd's socket protocol and records what was sent
+    def __init__(self):
+        self.path                           = os.path.join(tempfile.mkdtemp(), "lircd")
+        self.commands                       = []                # (command, perf_counter time)
+
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server.bind(self.path)
+        self.__server.listen(1)
+        self.__worker = threading.Thread(target=self.__serve_forever, name="fake-lircd", daemon=True)
+        self.__worker.start()
+
+    def __serve_forever(self):
+        while True:
+            conn, address = self.__server.accept()
+            with conn, conn.makefile("r") as lines:
+                for line in lines:
+                    command = line.strip()
+                    self.commands.append((command, time.perf_counter()))
+                    conn.sendall("BEGIN\n{}\nSUCCESS\nEND\n".format(command).encode())
+
+
+class SimBackend(Backend):
+    def __init__(self):
+        self.broker                         = LocalBroker()
+        self.dht                            = FakeDHT()
+        self.thermal                        = FakeThermal()
+        self.lircd                          = FakeLircd()
+
+        self.clients                        = []                # every SimMQTTClient handed out
+
+        def mqtt_client(username, key):
+            client = SimMQTTClient(username, key, self.broker)
+            self.clients.append(client)
+            return client
+
+        super().__init__(SimGPIO(), mqtt_client, self.dht.read, self.thermal.read, self.lircd.path)
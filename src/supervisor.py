@@ -0,0 +1,74 @@
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+
+
+class Supervisor:
+    # runs every target in its own process and starts it again when it dies, the others keep going
+    __MIN_BACKOFF                           = 1                 # seconds
+    __MAX_BACKOFF                           = 60                # seconds
+
+    def __init__(self, context=None):
+        # fork, the targets share whatever was set up before they started
+        self.__context                      = context if context is not None else multiprocessing.get_context("fork")
+        self.__targets                      = {}                # name -> (target, nice)
+        self.__processes                    = {}                # name -> running process
+        self.__started                      = {}                # name -> monotonic time it was last started
+        self.__restarts                     = {}                # name -> monotonic time it's due to be started again
+        self.__backoffs                     = {}                # name -> seconds before the next restart
+
+        self.__logger                       = logging.getLogger(__name__)
+
+    def add(self, name, target, nice=0):
+        # target() runs in a new process, nice is added to its priority (lowering it needs root)
+        self.__targets[name] = (target, nice)
+        self.__backoffs[name] = self.__MIN_BACKOFF
+    def run_forever(self):
+        for name in self.__targets:
+            self.__start(name)
+
+        while True:
+            now = time.monotonic()
+            for name, restart_time in list(self.__restarts.items()):
+                if restart_time <= now:
+                    del self.__restarts[name]
+                    self.__start(name)
+
+            timeout = max(min(self.__restarts.values()) - now, 0) if self.__restarts else None
+            sentinels = dict((process.sentinel, name) for name, process in self.__processes.items())
+            for sentinel in wait(list(sentinels), timeout):
+                self.__exited(sentinels[sentinel])
+    def stop(self):
+        for process in self.__processes.values():
+            process.terminate()
+        for process in self.__processes.values():
+            process.join()
+        self.__processes = {}
+
+    def __start(self, name):
+        target, nice = self.__targets[name]
+        process = self.__context.Process(target=self.__run, args=(target, nice), name=name)
+        process.start()
+        self.__processes[name] = process
+        self.__started[name] = time.monotonic()
+    def __exited(self, name):
+        process = self.__processes.pop(name)
+        process.join()
+
+        # a process that held up is started again after a second, one that keeps crashing backs off
+        if time.monotonic() - self.__started[name] >= self.__MAX_BACKOFF:
+            self.__backoffs[name] = self.__MIN_BACKOFF
+        delay = self.__backoffs[name]
+        self.__backoffs[name] = min(delay * 2, self.__MAX_BACKOFF)
+
+        self.__logger.error("{} exited with {}, restarting in {}s".format(name, process.exitcode, delay))
+        self.__restarts[name] = time.monotonic() + delay
+    def __run(self, target, nice):
+        if nice:
+            try:
+                os.nice(nice)
+            except OSError as e:
+                self.__logger.warning("priority of {} not changed: {}".format(multiprocessing.current_process().name, e))
+        target()
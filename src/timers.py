@@ -0,0 +1,66 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class TimerScheduler:
+    # run by the main loop, which sleeps until the deadline returned by run_due()
+    def __init__(self):
+        self.__lock                         = threading.Lock()
+        self.__timers                       = []                # heap of (deadline, timer)
+        self.__pending                      = {}                # timer -> (callback, interval or None)
+        self.__ids                          = itertools.count()
+
+        self.__logger                       = logging.getLogger(__name__)
+
+    def call_later(self, delay, callback):
+        # callback() once after delay seconds, returns a timer that can be cancelled
+        return self.__add(delay, callback, None)
+    def call_every(self, interval, callback, delay=None):
+        # callback() after delay (default interval) seconds then every interval, each deadline is set from
+        # the previous one so late runs don't push the schedule back
+        return self.__add(interval if delay is None else delay, callback, interval)
+    def cancel(self, timer):
+        with self.__lock:
+            self.__pending.pop(timer, None)
+    def run_due(self):
+        # runs every timer that was due when called, returns seconds until the next deadline (0 if one came due
+        # meanwhile) or None if nothing is scheduled. a callback scheduling itself with no delay waits for the next
+        # call so the network is serviced in between
+        start = time.monotonic()
+        while True:
+            with self.__lock:
+                if not self.__timers:
+                    return None
+
+                deadline, timer = self.__timers[0]
+                if timer not in self.__pending:
+                    # cancelled
+                    heapq.heappop(self.__timers)
+                    continue
+                if deadline > start:
+                    return max(deadline - time.monotonic(), 0)
+                now = time.monotonic()
+
+                heapq.heappop(self.__timers)
+                callback, interval = self.__pending[timer]
+                if interval is None:
+                    del self.__pending[timer]
+                else:
+                    # skip runs that were missed entirely instead of firing them back to back
+                    missed = (now - deadline) // interval
+                    heapq.heappush(self.__timers, (deadline + (missed + 1) * interval, timer))
+
+            try:
+                callback()
+            except Exception:
+                self.__logger.exception("")
+
+    def __add(self, delay, callback, interval):
+        with self.__lock:
+            timer = next(self.__ids)
+            self.__pending[timer] = (callback, interval)
+            heapq.heappush(self.__timers, (time.monotonic() + delay, timer))
+            return timer